@@ -0,0 +1,101 @@
+'''
+tf.data input pipelines for the data providers.
+
+With a dataset the training batches are produced inside the TF runtime and
+prefetched while the previous step runs, instead of being handed over with a
+feed_dict on every step. Pass the dataset to the unet with `input_fn`:
+
+    net = unet.Unet(channels=generator.channels, n_class=generator.n_class,
+                    input_fn=lambda: file_dataset(generator, batch_size=4))
+
+`file_dataset` loads the samples of the provider's file list with a parallel
+map (optionally cached in memory), `provider_dataset` works with any provider
+by drawing whole batches from it.
+'''
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+import numpy as np
+import tensorflow as tf
+
+from image_util import modality_dropout
+
+
+def _modality_dropout(dataset, data_provider):
+    if data_provider.rmvd_rate <= 0:
+        return dataset
+    channels = data_provider.channels
+
+    def drop(batch_x):
+        # py_func inputs may share memory with the graph, work on a copy
+        return modality_dropout(np.array(batch_x), data_provider.rmvd_rate, data_provider.rng)
+
+    def apply(batch_x, batch_y):
+        batch_x = tf.py_func(drop, [batch_x], tf.float32, stateful=True)
+        batch_x.set_shape([None, None, None, channels])
+        return batch_x, batch_y
+
+    return dataset.map(apply)
+
+
+def file_dataset(data_provider, batch_size, num_parallel_calls=4, prefetch=2, cache=False, shuffle=True):
+    """
+    Dataset of (x, labels) batches loaded from the file list of a provider
+
+    :param data_provider: provider with `data_files` and `load_sample`, e.g. fourChannelProvider
+    :param batch_size: number of samples per batch
+    :param num_parallel_calls: (optional) samples loaded in parallel, default=4
+    :param prefetch: (optional) batches prepared ahead of the training step, default=2
+    :param cache: (optional) keep the loaded samples in memory after the first epoch, default=False
+    :param shuffle: (optional) reshuffle the samples every epoch, default=True
+    :returns dataset: endless dataset of float32 [batch_size, nx, ny, channels] and uint8 [batch_size, nx, ny]
+    """
+    # the provider shuffles data_files in place, keep the order the indices refer to
+    entries = list(data_provider.data_files)
+    channels = data_provider.channels
+
+    def load(idx):
+        data, label = data_provider.load_sample(entries[idx])
+        return np.asarray(data, dtype=np.float32), np.asarray(label, dtype=np.uint8)
+
+    def load_sample(idx):
+        data, label = tf.py_func(load, [idx], [tf.float32, tf.uint8], stateful=False)
+        data.set_shape([None, None, channels])
+        label.set_shape([None, None])
+        return data, label
+
+    dataset = tf.data.Dataset.range(len(entries))
+    if cache:
+        dataset = dataset.map(load_sample, num_parallel_calls=num_parallel_calls).cache()
+        if shuffle:
+            dataset = dataset.shuffle(len(entries))
+        dataset = dataset.repeat()
+    else:
+        if shuffle:
+            dataset = dataset.shuffle(len(entries))
+        dataset = dataset.repeat().map(load_sample, num_parallel_calls=num_parallel_calls)
+
+    dataset = _modality_dropout(dataset.batch(batch_size), data_provider)
+    return dataset.prefetch(prefetch)
+
+
+def provider_dataset(data_provider, batch_size, prefetch=2):
+    """
+    Dataset of (x, labels) batches drawn from any provider
+
+    :param data_provider: callable provider, e.g. GrayScaleDataProvider
+    :param batch_size: number of samples per batch
+    :param prefetch: (optional) batches prepared ahead of the training step, default=2
+    :returns dataset: endless dataset of float32 [batch_size, nx, ny, channels] and uint8 [batch_size, nx, ny]
+    """
+    def batches():
+        while True:
+            # the dataset holds several batches at a time, give each one its own arrays
+            batch = data_provider.next_batch(batch_size)
+            batch_x, batch_y = batch[0].copy(), batch[1].copy()
+            data_provider.release(batch)
+            yield batch_x, batch_y
+
+    shapes = (tf.TensorShape([batch_size, None, None, data_provider.channels]),
+              tf.TensorShape([batch_size, None, None]))
+    dataset = tf.data.Dataset.from_generator(batches, (tf.float32, tf.uint8), shapes)
+    return dataset.prefetch(prefetch)
@@ -26,6 +26,7 @@ import glob
 import os
 from image_util import BaseDataProvider
 from parameter import Parameter
+from volume_store import VolumeStore
 
 class GrayScaleDataProvider(BaseDataProvider):
     channels = 1
@@ -120,10 +121,94 @@ def to_rgb(img):
 
 para = Parameter()
 
-class oneChannelProvider(BaseDataProvider):
-    def __init__(self, search_path, a_min=None, a_max=None, data_suffix="fat.npy",
-                 mask_suffix='label.npy', shuffle_data=True, n_class = 2):
-        super(oneChannelProvider, self).__init__(a_min, a_max)
+# slice offset of every entry of the 5 slice stacks written by data_processing/to2.5D.py,
+# [i-1, i, i, i, i+1] with the border slice replicated at both ends of the volume
+STACK_OFFSETS = (-1, 0, 0, 0, 1)
+
+def _stack_indices(window):
+    """
+    Entries of a to2.5D.py stack that give the slices i-window//2 .. i+window//2,
+    the same slices VolumeStore.window cuts with edge='replicate'
+
+    :param window: odd number of slices
+    :returns indices: list of stack entries, e.g. [0, 2, 4] for window=3
+    """
+    offsets = range(-(window // 2), window // 2 + 1)
+    if window % 2 == 0 or any(offset not in STACK_OFFSETS for offset in offsets):
+        raise ValueError("The 2.5D slice files can not serve a window of %d slices" % window)
+    # the centre slice is taken from the middle entry
+    return [STACK_OFFSETS.index(offset) if offset else len(STACK_OFFSETS) // 2 for offset in offsets]
+
+def read_modalities(path, modalities, data_suffix="fat.npy", out=None, window=1, edge='replicate'):
+    """
+    Reads the modality files of one slice into a single float32 array of
+    len(modalities) * window channels, modality major (fat[i-1], fat[i], fat[i+1],
+    inn[i-1], ...). 2D files give one slice per modality. The 2.5D files of
+    to2.5D.py ([5, H, W], see STACK_OFFSETS) give the slices i-window//2 .. i+window//2,
+    which are the slices of VolumeStore.window with edge='replicate'.
+
+    :param path: file of the slice, e.g. data/test/01/0/01_0_fat.npy
+    :param modalities: modalities in channel order, e.g. ['fat', 'inn', 'wat', 'opp']
+    :param data_suffix: (optional) suffix of `path` that is replaced by the modality names, default='fat.npy'
+    :param out: (optional) array to fill, e.g. one slice of a preallocated volume. Shape [H, W, channels]
+    :param window: (optional) odd number of slices per modality, 1 or 3 for 2.5D files, default=1
+    :param edge: (optional) border handling the caller expects, see volume_store.window_indices. The
+        files only hold 'replicate' windows, default='replicate'
+    :returns out: the filled array
+    """
+    if window > 1 and edge != 'replicate':
+        raise ValueError("The 2.5D slice files replicate the border slices, edge '%s' needs the volume store" % edge)
+    for i, modality in enumerate(modalities):
+        modality_path = path.replace(data_suffix, modality + ".npy")
+        img = np.load(modality_path)
+        if img.ndim == 2 and window == 1:
+            img = img[np.newaxis]
+        elif img.ndim == 3 and img.shape[0] == len(STACK_OFFSETS):
+            img = img[_stack_indices(window)]
+        else:
+            raise ValueError("%s of shape %s can not serve a window of %d slices" % (modality_path, img.shape, window))
+        if out is None:
+            out = np.empty(img.shape[1:] + (window * len(modalities),), dtype=np.float32)
+        out[..., i*window:(i+1)*window] = np.moveaxis(img, 0, -1)
+    return out
+
+def read_modality_volume(paths, modalities, data_suffix="fat.npy", window=1, edge='replicate'):
+    """
+    Reads the slices of a patient into one preallocated float32 volume with `read_modalities`
+
+    :param paths: files of the slices in volume order
+    :returns volume: Shape [slices, H, W, channels]
+    """
+    first = read_modalities(paths[0], modalities, data_suffix, window=window, edge=edge)
+    volume = np.empty((len(paths),) + first.shape, dtype=np.float32)
+    volume[0] = first
+    for j in range(1, len(paths)):
+        read_modalities(paths[j], modalities, data_suffix, out=volume[j], window=window, edge=edge)
+    return volume
+
+class ModalityProvider(BaseDataProvider):
+    """
+    Data provider for the per slice modality files, e.g. data/train/01/0/01_0_fat.npy,
+    01_0_inn.npy, ... and 01_0_label.npy. The modalities of a sample are read with
+    `read_modalities`, the same assembler the prediction scripts use.
+
+    :param search_path: a glob search pattern to find the files of all slices
+    :param modalities: modalities in channel order, e.g. Parameter.modalities
+    :param a_min: (optional) min value used for clipping
+    :param a_max: (optional) max value used for clipping
+    :param data_suffix: suffix pattern of the file that identifies a slice. Default 'fat.npy'
+    :param mask_suffix: suffix pattern for the label files. Default 'label.npy'
+    :param shuffle_data: if the order of the loaded file path should be randomized. Default 'True'
+    :param n_class: (optional) number of classes, default=2
+    :param window: (optional) odd number of slices per modality taken from 2.5D files, default=1
+    :param edge: (optional) border handling of the window, only 'replicate' for 2.5D files, default='replicate'
+    """
+    def __init__(self, search_path, modalities, a_min=None, a_max=None, data_suffix="fat.npy",
+                 mask_suffix='label.npy', shuffle_data=True, n_class = 2, window=1, edge='replicate'):
+        super(ModalityProvider, self).__init__(a_min, a_max)
+        self.modalities = list(modalities)
+        self.window = window
+        self.edge = edge
         self.data_suffix = data_suffix
         self.mask_suffix = mask_suffix
         self.file_idx = -1
@@ -139,20 +224,14 @@ class oneChannelProvider(BaseDataProvider):
         print("Number of files used: %s" % len(self.data_files))
         
         img = self._load_file(self.data_files[0])
-        self.channels = 1 if len(img.shape) == 2 else img.shape[-1]
+        self.channels = img.shape[-1]
         
     def _find_data_files(self, search_path):
         all_files = glob.glob(search_path)
         return [name for name in all_files if self.data_suffix in name]
     
     def _load_file(self, path, dtype=np.float32):
-        fat_path = path.replace(self.data_suffix, "opp.npy")
-        fat_img = np.array(np.load(fat_path), dtype=dtype)
-
-        img = np.zeros((fat_img.shape[0], fat_img.shape[1], 1), dtype=dtype)
-        img[...,0] = fat_img
-
-        return img
+        return read_modalities(path, self.modalities, self.data_suffix, window=self.window, edge=self.edge)
 
     def _load_label(self, path, dtype=np.bool):
         return np.array(np.load(path), dtype=dtype) 
@@ -165,8 +244,12 @@ class oneChannelProvider(BaseDataProvider):
                 np.random.shuffle(self.data_files)
         
     def _next_data(self):
-        self._cylce_file()
-        image_name = self.data_files[self.file_idx]
+        with self._file_lock:
+            self._cylce_file()
+            image_name = self.data_files[self.file_idx]
+        return self._read_cached(image_name)
+
+    def _read_entry(self, image_name):
         label_name = image_name.replace(self.data_suffix, self.mask_suffix)
         
         img = self._load_file(image_name, np.float32)
@@ -174,177 +257,53 @@ class oneChannelProvider(BaseDataProvider):
     
         return img,label
 
-    def __call__(self, n):
-        train_data, labels = self._load_data_and_label()
-        nx = train_data.shape[1]
-        ny = train_data.shape[2]
-    
-        X = np.zeros((n, nx, ny, self.channels))
-        Y = np.zeros((n, nx, ny, self.n_class))
-    
-        X[0] = train_data
-        Y[0] = labels
-        for i in range(1, n):
-            train_data, labels = self._load_data_and_label()
-            X[i] = train_data
-            Y[i] = labels       
-    
-        return X, Y
-
-class fourChannelProvider(BaseDataProvider):
-    def __init__(self, search_path, a_min=None, a_max=None, data_suffix="fat.npy",
-                 mask_suffix='label.npy', shuffle_data=True, n_class = 2):
-        super(fourChannelProvider, self).__init__(a_min, a_max)
-        self.data_suffix = data_suffix
-        self.mask_suffix = mask_suffix
+class oneChannelProvider(ModalityProvider):
+    def __init__(self, search_path, *args, **kwargs):
+        super(oneChannelProvider, self).__init__(search_path, ['opp'], *args, **kwargs)
+
+class fourChannelProvider(ModalityProvider):
+    def __init__(self, search_path, *args, **kwargs):
+        super(fourChannelProvider, self).__init__(search_path, ['fat', 'inn', 'wat', 'opp'], *args, **kwargs)
+
+class eightChannelProvider(ModalityProvider):
+    def __init__(self, search_path, *args, **kwargs):
+        super(eightChannelProvider, self).__init__(search_path, ['fat', 'inn', 'wat', 'opp', 'fin', 'win', 'wop', 'iop'],
+                                                   *args, **kwargs)
+
+class volumeChannelProvider(BaseDataProvider):
+    """
+    Data provider for a volume store (see volume_store.py). Every sample is a
+    (patient, slice) pair and its image is a view into the memory mapped
+    patient volume, so no file is opened per sample.
+
+    :param store_path: root directory of the volume store
+    :param modalities: (optional) modalities in channel order. Default: all stored modalities
+    :param window: (optional) odd number of neighbouring slices per modality (2.5D input), default=1
+    :param edge: (optional) border handling of the slice window, see volume_store.window_indices
+    :param a_min: (optional) min value used for clipping
+    :param a_max: (optional) max value used for clipping
+    :param shuffle_data: if the order of the samples should be randomized. Default 'True'
+    :param n_class: (optional) number of classes, default=2
+    """
+    def __init__(self, store_path, modalities=None, window=1, edge='replicate', a_min=None, a_max=None,
+                 shuffle_data=True, n_class = 2):
+        super(volumeChannelProvider, self).__init__(a_min, a_max)
+        self.store = VolumeStore(store_path, modalities)
+        self.window = window
+        self.edge = edge
         self.file_idx = -1
         self.shuffle_data = shuffle_data
         self.n_class = n_class
-        
-        self.data_files = self._find_data_files(search_path)
-        
-        if self.shuffle_data:
-            np.random.shuffle(self.data_files)
-        
-        assert len(self.data_files) > 0, "No training files"
-        print("Number of files used: %s" % len(self.data_files))
-        
-        img = self._load_file(self.data_files[0])
-        self.channels = 1 if len(img.shape) == 2 else img.shape[-1]
-        
-    def _find_data_files(self, search_path):
-        all_files = glob.glob(search_path)
-        return [name for name in all_files if self.data_suffix in name]
-
-    
-    def _load_file(self, path, dtype=np.float32):
-        fat_path = path.replace(self.data_suffix, "fat.npy")
-        inn_path = path.replace(self.data_suffix, "inn.npy")
-        wat_path = path.replace(self.data_suffix, "wat.npy")
-        opp_path = path.replace(self.data_suffix, "opp.npy")
-        fat_img = np.array(np.load(fat_path), dtype=dtype)
-        inn_img = np.array(np.load(inn_path), dtype=dtype)
-        wat_img = np.array(np.load(wat_path), dtype=dtype)
-        opp_img = np.array(np.load(opp_path), dtype=dtype)
-
-        img = np.zeros((fat_img.shape[0], fat_img.shape[1], 4), dtype=dtype)
-        img[...,0] = fat_img
-        img[...,1] = inn_img
-        img[...,2] = wat_img
-        img[...,3] = opp_img
-
-        return img
-
-    def _load_label(self, path, dtype=np.bool):
-        return np.array(np.load(path), dtype=dtype) 
-
-    def _cylce_file(self):
-        self.file_idx += 1
-        if self.file_idx >= len(self.data_files):
-            self.file_idx = 0 
-            if self.shuffle_data:
-                np.random.shuffle(self.data_files)
-        
-    def _next_data(self):
-        self._cylce_file()
-        image_name = self.data_files[self.file_idx]
-        label_name = image_name.replace(self.data_suffix, self.mask_suffix)
-        
-        img = self._load_file(image_name, np.float32)
-        label = self._load_label(label_name, np.bool)
-    
-        return img,label
 
-    def __call__(self, n):
-        train_data, labels = self._load_data_and_label()
-        nx = train_data.shape[1]
-        ny = train_data.shape[2]
-    
-        X = np.zeros((n, nx, ny, self.channels))
-        Y = np.zeros((n, nx, ny, self.n_class))
-    
-        X[0] = train_data
-        Y[0] = labels
-        for i in range(1, n):
-            train_data, labels = self._load_data_and_label()
-            X[i] = train_data
-            Y[i] = labels
-
-        if para.RMVD:
-            for i in range(0, n):
-                if np.random.rand() >para.RMVD_value:
-                    tmp = np.random.rand()
-                    x = np.zeros((nx, ny))
-                    if tmp < 0.25:
-                        X[i, ..., 0] = x
-                    elif tmp>=0.25 and tmp<0.5:
-                        X[i, ..., 1] = x
-                    elif tmp>=0.5 and tmp<0.75:
-                        X[i, ..., 2] = x
-                    elif tmp>=0.75:
-                        X[i, ..., 3] = x
-                    X[i] = X[i]/0.75        
-    
-        return X, Y
+        self.data_files = self.store.samples()
 
-class eightChannelProvider(BaseDataProvider):
-    def __init__(self, search_path, a_min=None, a_max=None, data_suffix="fat.npy",
-                 mask_suffix='label.npy', shuffle_data=True, n_class = 2):
-        super(eightChannelProvider, self).__init__(a_min, a_max)
-        self.data_suffix = data_suffix
-        self.mask_suffix = mask_suffix
-        self.file_idx = -1
-        self.shuffle_data = shuffle_data
-        self.n_class = n_class
-        
-        self.data_files = self._find_data_files(search_path)
-        
         if self.shuffle_data:
             np.random.shuffle(self.data_files)
-        
-        assert len(self.data_files) > 0, "No training files"
-        print("Number of files used: %s" % len(self.data_files))
-        
-        img = self._load_file(self.data_files[0])
-        self.channels = 1 if len(img.shape) == 2 else img.shape[-1]
-        
-    def _find_data_files(self, search_path):
-        all_files = glob.glob(search_path)
-        return [name for name in all_files if self.data_suffix in name]
-    
 
-    def _load_file(self, path, dtype=np.float32):
-        fat_path = path.replace(self.data_suffix, "fat.npy")
-        inn_path = path.replace(self.data_suffix, "inn.npy")
-        wat_path = path.replace(self.data_suffix, "wat.npy")
-        opp_path = path.replace(self.data_suffix, "opp.npy")
-        fin_path = path.replace(self.data_suffix, "fin.npy")
-        win_path = path.replace(self.data_suffix, "win.npy")
-        wop_path = path.replace(self.data_suffix, "wop.npy")
-        iop_path = path.replace(self.data_suffix, "iop.npy")
-        fat_img = np.array(np.load(fat_path), dtype=dtype)
-        inn_img = np.array(np.load(inn_path), dtype=dtype)
-        wat_img = np.array(np.load(wat_path), dtype=dtype)
-        opp_img = np.array(np.load(opp_path), dtype=dtype)
-        fin_img = np.array(np.load(fin_path), dtype=dtype)
-        win_img = np.array(np.load(win_path), dtype=dtype)
-        wop_img = np.array(np.load(wop_path), dtype=dtype)
-        iop_img = np.array(np.load(iop_path), dtype=dtype)
-
-        img = np.zeros((fat_img.shape[0], fat_img.shape[1], 8), dtype=dtype)
-        img[...,0] = fat_img
-        img[...,1] = inn_img
-        img[...,2] = wat_img
-        img[...,3] = opp_img
-        img[...,4] = fin_img
-        img[...,5] = win_img
-        img[...,6] = wop_img
-        img[...,7] = iop_img
-
-        return img
+        assert len(self.data_files) > 0, "No training files"
+        print("Number of samples used: %s" % len(self.data_files))
 
-    def _load_label(self, path, dtype=np.bool):
-        return np.array(np.load(path), dtype=dtype) 
+        self.channels = self.store.channels * self.window
 
     def _cylce_file(self):
         self.file_idx += 1
@@ -352,38 +311,24 @@ class eightChannelProvider(BaseDataProvider):
             self.file_idx = 0 
             if self.shuffle_data:
                 np.random.shuffle(self.data_files)
-        
+
     def _next_data(self):
-        self._cylce_file()
-        image_name = self.data_files[self.file_idx]
-        label_name = image_name.replace(self.data_suffix, self.mask_suffix)
-        
-        img = self._load_file(image_name, np.float32)
-        label = self._load_label(label_name, np.bool)
-    
-        return img,label
+        with self._file_lock:
+            self._cylce_file()
+            entry = self.data_files[self.file_idx]
+        return self._read_cached(entry)
 
-    def __call__(self, n):
-        train_data, labels = self._load_data_and_label()
-        nx = train_data.shape[1]
-        ny = train_data.shape[2]
-    
-        X = np.zeros((n, nx, ny, self.channels))
-        Y = np.zeros((n, nx, ny, self.n_class))
-    
-        X[0] = train_data
-        Y[0] = labels
-        for i in range(1, n):
-            train_data, labels = self._load_data_and_label()
-            X[i] = train_data
-            Y[i] = labels        
-    
-        return X, Y
+    def _read_entry(self, entry):
+        patient, index = entry
+        img = self.store.window(patient, index, self.window, self.edge)
+        label = self.store.label(patient)[index] > 0
+
+        return img,label
 
 if __name__ == '__main__':
     root_address = para.root_address
     generator_address = os.path.join(root_address, 'data/train/*/*/*.npy')
-    generator = oneChannelProvider(generator_address)
+    generator = ModalityProvider(generator_address, para.modalities)
     a, b= generator(4)
     print(a.shape)
     print(b.shape)
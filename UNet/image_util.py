@@ -18,9 +18,117 @@ from __future__ import print_function, division, absolute_import, unicode_litera
 
 #import cv2
 import glob
+import logging
+import multiprocessing
+import threading
+import traceback
+from collections import OrderedDict, deque
 import numpy as np
 from PIL import Image
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+def modality_dropout(X, rate, rng=np.random):
+    """
+    Random modality dropout (RMVD) on a whole batch, in place. Every sample loses
+    one randomly chosen channel with probability `rate` and its remaining channels
+    are scaled by channels/(channels-1).
+
+    :param X: the batch. Shape [n, nx, ny, channels]
+    :param rate: probability that a sample loses a channel
+    :param rng: (optional) np.random.RandomState for reproducible draws, default: np.random
+    :returns X: the same array
+    """
+    n, channels = X.shape[0], X.shape[-1]
+    if channels < 2:
+        return X
+
+    dropped = np.flatnonzero(rng.rand(n) < rate)
+    channel = rng.randint(channels, size=len(dropped))
+    X[dropped, :, :, channel] = 0
+    # a contiguous in place scale per sample is cheaper than broadcasting a
+    # [n, channels] mask over the short channel axis of the whole batch
+    scale = X.dtype.type(channels / (channels - 1.))
+    for i in dropped:
+        X[i] *= scale
+    return X
+
+class SampleCache(object):
+    """
+    In-process LRU cache of assembled samples. Entries are kept until their
+    total size exceeds `max_bytes`, then the least recently used ones are dropped,
+    so a small training set stays in memory after the first epoch and a larger
+    one keeps the most recent samples. The cached arrays are read-only, the
+    processing hooks of the provider have to copy before they modify them.
+    Views, e.g. slices of the memory mapped volumes of volumeChannelProvider,
+    are copied before they are cached, so an entry holds its samples in memory
+    and does not pin the array it was cut from.
+
+    Every process holds its own cache, loader processes each use the full budget.
+    A pickled cache (e.g. for a spawned process) starts empty.
+
+    :param max_bytes: memory budget of the cached arrays
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return {'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_bytes'])
+
+    def get(self, key, load):
+        """
+        Cached arrays of `key`, calls `load(key)` on a miss
+
+        :param key: hashable sample id, e.g. the data file name
+        :param load: function returning the tuple of arrays of a sample
+        """
+        with self._lock:
+            arrays = self._entries.pop(key, None)
+            if arrays is not None:
+                self._entries[key] = arrays
+                self.hits += 1
+                return arrays
+            self.misses += 1
+
+        arrays = tuple(np.asarray(a) for a in load(key))
+        arrays = tuple(a if a.flags.owndata else a.copy() for a in arrays)
+        for a in arrays:
+            a.flags.writeable = False
+        size = sum(a.nbytes for a in arrays)
+        if size > self.max_bytes:
+            return arrays
+
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = arrays
+                self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, old = self._entries.popitem(last=False)
+                self.nbytes -= sum(a.nbytes for a in old)
+                self.evictions += 1
+        return arrays
+
+    def stats(self):
+        """
+        Hits, misses, evictions, number of cached samples and their size in MB
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'samples': len(self._entries), 'megabytes': self.nbytes / 2.**20}
+
 class BaseDataProvider(object):
     """
     Abstract base class for DataProvider implementation. Subclasses have to
@@ -30,6 +138,20 @@ class BaseDataProvider(object):
     method can be overwritten. To enable some post processing such as data
     augmentation the `_post_process` method can be overwritten.
 
+    Labels are uint8 class indices of shape [nx, ny]; the network does the one-hot
+    encoding in-graph.
+
+    With `rmvd_rate` > 0 every batch goes through `modality_dropout`, drawing from
+    `rng` (see `seed`).
+
+    Providers with a file list read their samples through `_read_cached`, which
+    goes to the `cache` (a SampleCache) if one is set.
+
+    Batches are float32 and are filled into preallocated buffers that are reused
+    once they are given back. A batch returned by a call stays valid until the
+    next call; copy it to keep it longer. Loaders that hold several batches at a
+    time take them with `next_batch` and give each one back with `release`.
+
     :param a_min: (optional) min value used for clipping
     :param a_max: (optional) max value used for clipping
 
@@ -37,11 +159,46 @@ class BaseDataProvider(object):
     
     channels = 1
     n_class = 2
+    rmvd_rate = 0.
+    rng = np.random
+    cache = None
     
 
     def __init__(self, a_min=None, a_max=None):
         self.a_min = a_min if a_min is not None else -np.inf
         self.a_max = a_max if a_min is not None else np.inf
+        self._file_lock = threading.Lock()
+        self._buffer_lock = threading.Lock()
+        self._free_buffers = {}
+        self._owned_buffers = {}
+        self._last_batch = None
+        self.batches = 0
+        self.buffer_allocations = 0
+        self.buffer_bytes = 0
+
+    def __getstate__(self):
+        # locks can not be pickled and the batch buffers stay with the process that owns them
+        state = self.__dict__.copy()
+        del state['_file_lock'], state['_buffer_lock']
+        state['_free_buffers'] = {}
+        state['_owned_buffers'] = {}
+        state['_last_batch'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._file_lock = threading.Lock()
+        self._buffer_lock = threading.Lock()
+
+    def sample_shape(self):
+        """
+        Shape [nx, ny] of the processed samples. Providers with a file list read their
+        first entry, so the order of the samples is not advanced.
+        """
+        if hasattr(self, 'data_files'):
+            return self.load_sample(self.data_files[0])[1].shape
+        train_data, _ = self._load_data_and_label()
+        return train_data.shape[1:3]
 
     def _load_data_and_label(self):
         data, label = self._next_data()
@@ -54,18 +211,33 @@ class BaseDataProvider(object):
         nx = train_data.shape[1]
         ny = train_data.shape[0]
 
-        return train_data.reshape(1, ny, nx, self.channels), labels.reshape(1, ny, nx, self.n_class),
+        return train_data.reshape(1, ny, nx, self.channels), labels.reshape(1, ny, nx),
+    
+    def load_sample(self, entry):
+        """
+        Processed data and label of one entry of `data_files`, for loaders that pick
+        the samples themselves (see dataset.py). Subclasses with a file list implement
+        `_read_entry`.
+
+        :returns data, label: shapes [nx, ny, channels] and [nx, ny]
+        """
+        data, label = self._read_cached(entry)
+        data = self._process_data(data)
+        label = self._process_labels(label)
+        data, label = self._post_process(data, label)
+        return data.reshape(data.shape[0], data.shape[1], self.channels), label
+    
+    def _read_cached(self, entry):
+        if self.cache is None:
+            return self._read_entry(entry)
+        return self.cache.get(entry, self._read_entry)
     
     def _process_labels(self, label):
-        if self.n_class == 2:
-            nx = label.shape[1]
-            ny = label.shape[0]
-            labels = np.zeros((ny, nx, self.n_class), dtype=np.float32)
-            labels[..., 1] = label
-            labels[..., 0] = ~label
-            return labels
+        if label.ndim == 3:
+            # one-hot label
+            return np.argmax(label, axis=-1).astype(np.uint8)
         
-        return label
+        return label.astype(np.uint8)
     
     def _process_data(self, data):
         
@@ -80,22 +252,90 @@ class BaseDataProvider(object):
         """
         return data, labels
     
+    def _batch_buffers(self, n, nx, ny):
+        """
+        Free X, Y buffers for a batch of shape [n, nx, ny]. Buffers are only allocated
+        when every buffer of that shape is still held by an unreleased batch.
+        """
+        with self._buffer_lock:
+            free = self._free_buffers.setdefault((n, nx, ny), [])
+            if free:
+                X, Y = free.pop()
+            else:
+                X = np.empty((n, nx, ny, self.channels), dtype=np.float32)
+                Y = np.empty((n, nx, ny), dtype=np.uint8)
+                self.buffer_allocations += 1
+                self.buffer_bytes += X.nbytes + Y.nbytes
+            self._owned_buffers[id(X)] = (X, Y)
+            self.batches += 1
+            return X, Y
+
+    def release(self, batch):
+        """
+        Gives the buffers of a batch from `next_batch` back for reuse. Batches that
+        did not come from this provider, or were already released, are ignored.
+        """
+        with self._buffer_lock:
+            buffers = self._owned_buffers.pop(id(batch[0]), None)
+            if buffers is not None:
+                X, Y = buffers
+                self._free_buffers[(X.shape[0], X.shape[1], X.shape[2])].append(buffers)
+
+    def seed(self, seed):
+        """
+        Gives the provider its own random generator for the modality dropout
+        """
+        self.rng = np.random.RandomState(seed)
+
+    def cache_stats(self):
+        """
+        Counters of the sample cache, None without a cache
+        """
+        return self.cache.stats() if self.cache is not None else None
+
+    def buffer_stats(self):
+        """
+        Number of batches drawn, number of buffer pairs allocated for them and their size in MB
+        """
+        return {'batches': self.batches, 'allocations': self.buffer_allocations,
+                'megabytes': self.buffer_bytes / 2.**20}
+
     def __call__(self, n):
+        # the previous batch of a direct caller is not used any more
+        if self._last_batch is not None:
+            self.release(self._last_batch)
+        self._last_batch = self.next_batch(n)
+        return self._last_batch
+
+    def next_batch(self, n):
+        """
+        Loads a batch into buffers that stay owned by the caller until `release`
+
+        :returns X, Y: Shapes [n, nx, ny, channels] and [n, nx, ny]
+        """
         train_data, labels = self._load_data_and_label()
         nx = train_data.shape[1]
         ny = train_data.shape[2]
     
-        X = np.zeros((n, nx, ny, self.channels))
-        Y = np.zeros((n, nx, ny, self.n_class))
+        X, Y = self._batch_buffers(n, nx, ny)
     
         X[0] = train_data
         Y[0] = labels
-        for i in range(1, n):
+        self._fill_batch(X, Y, start=1)
+    
+        return X, Y
+
+    def _fill_batch(self, X, Y, start=0):
+        """
+        Loads samples start..n-1 into the batch arrays X, Y and applies the batch transforms
+        """
+        for i in range(start, X.shape[0]):
             train_data, labels = self._load_data_and_label()
             X[i] = train_data
             Y[i] = labels
     
-        return X, Y
+        if self.rmvd_rate > 0:
+            modality_dropout(X, self.rmvd_rate, self.rng)
     
 class SimpleDataProvider(BaseDataProvider):
     """
@@ -182,11 +422,306 @@ class ImageDataProvider(BaseDataProvider):
                 np.random.shuffle(self.data_files)
         
     def _next_data(self):
-        self._cylce_file()
-        image_name = self.data_files[self.file_idx]
+        with self._file_lock:
+            self._cylce_file()
+            image_name = self.data_files[self.file_idx]
+        return self._read_cached(image_name)
+
+    def _read_entry(self, image_name):
         label_name = image_name.replace(self.data_suffix, self.mask_suffix)
         
         img = self._load_file(image_name, np.float32)
         label = self._load_file(label_name, np.bool)
     
         return img,label
+
+class PrefetchDataProvider(object):
+    """
+    Wraps a data provider and loads batches in background threads, so the
+    training loop only has to pick up batches that are already in memory.
+    Ready batches are kept in a bounded queue. Every batch keeps its buffers
+    until the next call, then they go back to the wrapped provider. The first
+    error of a loader thread stops the loaders and is raised by this and every
+    later call. Calls with a batch size other
+    than `batch_size` (e.g. the verification batch) go straight to the
+    wrapped provider.
+
+    Usage:
+    data_provider = PrefetchDataProvider(eightChannelProvider(path), batch_size=4)
+
+    :param data_provider: the data provider to wrap
+    :param batch_size: size of the prefetched batches
+    :param n_workers: (optional) number of loader threads, default=2
+    :param queue_size: (optional) maximum number of ready batches, default=8
+
+    """
+
+    def __init__(self, data_provider, batch_size, n_workers=2, queue_size=8):
+        self.data_provider = data_provider
+        self.batch_size = batch_size
+        self.channels = data_provider.channels
+        self.n_class = data_provider.n_class
+        self._in_use = None
+        self._error = None
+
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop_event = threading.Event()
+        self._workers = []
+        for _ in range(n_workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        while not self._stop_event.is_set():
+            try:
+                batch = self.data_provider.next_batch(self.batch_size)
+            except Exception as e:
+                # queued in place of the batch, __call__ raises it in the training thread
+                batch = e
+            while not self._stop_event.is_set():
+                try:
+                    self._queue.put(batch, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+            else:
+                # stopped with the batch still in hand
+                if not isinstance(batch, Exception):
+                    self.data_provider.release(batch)
+            if isinstance(batch, Exception):
+                return
+
+    def buffer_stats(self):
+        return self.data_provider.buffer_stats()
+
+    def cache_stats(self):
+        return self.data_provider.cache_stats()
+
+    def qsize(self):
+        """
+        Number of batches that are ready to be consumed
+        """
+        return self._queue.qsize()
+
+    def stop(self):
+        """
+        Stops the loader threads. The wrapped provider can still be called directly.
+        """
+        self._stop_event.set()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def __call__(self, n):
+        if self._error is not None:
+            raise self._error
+        if n != self.batch_size or not self._workers:
+            return self.data_provider(n)
+
+        # the batch of the previous call has been consumed, its buffers can be refilled
+        if self._in_use is not None:
+            self.data_provider.release(self._in_use)
+            self._in_use = None
+        batch = self._queue.get()
+        if isinstance(batch, Exception):
+            # the failed thread is gone, a retry would wait for the others forever
+            self._error = batch
+            self.stop()
+            raise batch
+        self._in_use = batch
+        return batch
+
+def _seed_worker(data_provider, seed):
+    np.random.seed(seed)
+    data_provider.seed(seed)
+    # forked workers start with the same file order, give every worker its own
+    if getattr(data_provider, 'shuffle_data', False) and hasattr(data_provider, 'data_files'):
+        np.random.shuffle(data_provider.data_files)
+
+def _slot_views(x_block, y_block, x_shape, y_shape):
+    X = np.frombuffer(x_block, dtype=np.float32).reshape((-1,) + x_shape)
+    Y = np.frombuffer(y_block, dtype=np.uint8).reshape((-1,) + y_shape)
+    return X, Y
+
+def _fill_slots(data_provider, seed, blocks, free_queue, ready_queue, stop_event):
+    """
+    Loader process: takes free slots of its own, fills them and reports them ready
+    together with the counters of its sample cache
+    """
+    X, Y = _slot_views(*blocks)
+    _seed_worker(data_provider, seed)
+    while not stop_event.is_set():
+        try:
+            slot = free_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if slot is None:
+            return
+        try:
+            data_provider._fill_batch(X[slot], Y[slot])
+        except Exception:
+            # the exception itself may not pickle, the traceback text goes with the slot
+            ready_queue.put((slot, traceback.format_exc(), None))
+            return
+        ready_queue.put((slot, None, data_provider.cache_stats()))
+
+class MultiprocessDataProvider(object):
+    """
+    Wraps a data provider and loads batches in worker processes, so CPU heavy
+    `_post_process` augmentation is not serialised by the GIL. Workers fill
+    batch slots in shared memory and the training process gets views of them
+    without a copy. A returned batch stays valid until the next call.
+
+    Every worker owns `slots // n_workers` slots. A worker that dies is
+    restarted and every slot of it that is neither in use nor reported ready is
+    handed to the new process. A worker that reports an error is not restarted,
+    the error is raised by the next call. Worker
+    i draws its random numbers from `seed + i` (seeded from the OS if seed is None),
+    a restarted worker continues with the next seed of its sequence.
+    Calls with a batch size other than `batch_size` go straight to the wrapped provider.
+    The wrapped provider is pickled for the workers unless the start method is fork,
+    its sample cache then starts empty in every worker.
+
+    Usage:
+    data_provider = MultiprocessDataProvider(eightChannelProvider(path), batch_size=4)
+    ...
+    data_provider.stop()
+
+    :param data_provider: the data provider to wrap
+    :param batch_size: size of the prefetched batches
+    :param n_workers: (optional) number of loader processes, default=4
+    :param slots: (optional) number of shared memory batch slots, default=2*n_workers
+    :param seed: (optional) base seed of the workers, default=None
+    """
+
+    def __init__(self, data_provider, batch_size, n_workers=4, slots=None, seed=None):
+        self.data_provider = data_provider
+        self.batch_size = batch_size
+        self.channels = data_provider.channels
+        self.n_class = data_provider.n_class
+        self.n_workers = n_workers
+        self.seed = seed
+        self.restarts = 0
+
+        slots = max(slots or 2 * n_workers, 2 * n_workers)
+        nx, ny = data_provider.sample_shape()
+        x_shape = (batch_size, nx, ny, self.channels)
+        y_shape = (batch_size, nx, ny)
+        # one shared block per array, each slot is a view into it
+        x_block = multiprocessing.RawArray('f', slots * int(np.prod(x_shape)))
+        y_block = multiprocessing.RawArray('B', slots * int(np.prod(y_shape)))
+        self._blocks = (x_block, y_block, x_shape, y_shape)
+        self._X, self._Y = _slot_views(*self._blocks)
+
+        # ready reports that were taken from the queue but not handed out yet
+        self._ready = deque()
+        self._cache_stats = [None] * n_workers
+        self._ready_queue = multiprocessing.Queue()
+        self._stop_event = multiprocessing.Event()
+        self._free_queues = [None] * n_workers
+        self._workers = [None] * n_workers
+        self._generation = [0] * n_workers
+        self._in_use = None
+        for worker in range(n_workers):
+            self._start_worker(worker)
+
+    def _worker_slots(self, worker):
+        return range(worker, self._X.shape[0], self.n_workers)
+
+    def _worker_seed(self, worker):
+        if self.seed is None:
+            return None
+        return (self.seed + worker + self.n_workers * self._generation[worker]) % 2**32
+
+    def _start_worker(self, worker):
+        # a fresh queue, the old one may be broken if the process died while using it
+        free_queue = multiprocessing.Queue()
+        ready = set(report[0] for report in self._ready)
+        for slot in self._worker_slots(worker):
+            if slot != self._in_use and slot not in ready:
+                free_queue.put(slot)
+        process = multiprocessing.Process(target=_fill_slots,
+                                          args=(self.data_provider, self._worker_seed(worker), self._blocks,
+                                                free_queue, self._ready_queue, self._stop_event))
+        process.daemon = True
+        process.start()
+        self._free_queues[worker] = free_queue
+        self._workers[worker] = process
+
+    def _collect_ready(self):
+        while True:
+            try:
+                self._ready.append(self._ready_queue.get_nowait())
+            except queue.Empty:
+                return
+
+    def _check_workers(self):
+        # workers that reported an error or were stopped exit with code 0
+        dead = [worker for worker, process in enumerate(self._workers)
+                if not process.is_alive() and process.exitcode != 0]
+        if not dead:
+            return
+        # what a dead worker reported before it died is still queued, only the rest of its slots are lost
+        self._collect_ready()
+        for worker in dead:
+            logging.warning("Loader process {} died with exit code {}, restarting".format(
+                worker, self._workers[worker].exitcode))
+            self._generation[worker] += 1
+            self.restarts += 1
+            self._start_worker(worker)
+
+    def _release(self):
+        if self._in_use is not None:
+            slot = self._in_use
+            self._in_use = None
+            self._free_queues[slot % self.n_workers].put(slot)
+
+    def buffer_stats(self):
+        return self.data_provider.buffer_stats()
+
+    def cache_stats(self):
+        """
+        Counters of the sample caches summed over the running workers, None without a cache
+        """
+        stats = [worker_stats for worker_stats in self._cache_stats if worker_stats is not None]
+        if not stats:
+            return self.data_provider.cache_stats()
+        return dict((key, sum(worker_stats[key] for worker_stats in stats)) for key in stats[0])
+
+    def stop(self):
+        """
+        Stops the loader processes. The wrapped provider can still be called directly.
+        """
+        if self._stop_event.is_set():
+            return
+        self._stop_event.set()
+        for free_queue in self._free_queues:
+            free_queue.put(None)
+        for process in self._workers:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+    def __call__(self, n):
+        if n != self.batch_size or self._stop_event.is_set():
+            return self.data_provider(n)
+
+        # the previous batch is handed back to its worker
+        self._release()
+        self._check_workers()
+        while not self._ready:
+            try:
+                self._ready.append(self._ready_queue.get(timeout=1.))
+            except queue.Empty:
+                self._check_workers()
+        slot, error, stats = self._ready.popleft()
+        if error is not None:
+            self.stop()
+            raise RuntimeError("Loader process failed:\n" + error)
+
+        if stats is not None:
+            self._cache_stats[slot % self.n_workers] = stats
+        self._in_use = slot
+        return self._X[slot], self._Y[slot]
@@ -12,7 +12,11 @@ class Parameter(object):
         self.root_address = '/DATA5_DB8/data/sxfeng/data/IVDNet/experiment/8modality_2'
         self.cost = 'CE' #name of the cost function. cross_entropy , dice
         self.regularizer=None       #power of the L2 regularizers added to the loss function
-        self.channel=8
+        self.modalities=['fat', 'inn', 'wat', 'opp', 'fin', 'win', 'wop', 'iop']    #channel order of the input
+        self.channel=len(self.modalities)
+        self.volume_store=False     #read data/train_store and data/test_store instead of the per-slice .npy files
+        self.slice_window=1         #neighbouring slices per modality (2.5D), odd. 2.5D slice files serve 1 or 3, the volume store any
+        self.slice_edge='replicate' #border handling of the slice window: replicate, reflect or zero
         self.layers=5
         self.features_root=32
         self.batch_size=4
@@ -25,5 +29,23 @@ class Parameter(object):
         self.decay_rate=0.5
         self.decay_epochs=80
         self.mask=0.5
+        self.predict_batch_size=0   #slices per inference run, 0 feeds the whole volume at once
+        self.save_slices=False      #also write the per slice pre_image files next to the pre_voxel volumes
+        self.voxel_size=256         #in-plane size of the ground truth volumes, pre_voxel masks are resized to it
+        self.mask_rle=False         #run length encode the saved masks and labeled volumes instead of bit packing them
+        self.preview=False          #write png previews, rendered with PIL in separate processes
+        self.preview_workers=2      #processes rendering the previews
+        self.pipeline_queue_size=2  #patients waiting between loading, prediction and writing
+        self.pipeline_writers=2     #threads writing the predictions
         self.RMVD=False
-        self.RMVD_value=0.5
\ No newline at end of file
+        self.RMVD_value=0.5
+        self.RMVD_seed=None         #seed of the modality dropout draws, None for unseeded
+        self.prefetch=True          #load training batches in background threads
+        self.prefetch_workers=2     #number of loader threads
+        self.prefetch_queue_size=8  #maximum number of batches waiting in the queue
+        self.prefetch_processes=False #load batches in worker processes into shared memory instead of threads
+        self.sample_cache_mb=0      #memory budget in MB for keeping loaded samples between epochs (per loader process), 0 disables
+        self.tf_data=False          #train from a tf.data pipeline instead of feed_dict batches
+        self.tf_data_parallel=4     #samples loaded in parallel by the tf.data pipeline
+        self.tf_data_cache=False    #keep the loaded samples in memory after the first epoch
+        self.eval_workers=4         #processes evaluating patients in parallel
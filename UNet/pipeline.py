@@ -0,0 +1,148 @@
+'''
+Pipelined inference.
+
+Three stages run at the same time on consecutive patients:
+
+    loader thread  ->  session (calling thread)  ->  writer threads
+    assemble input     predict_volume                save masks / previews
+
+Both queues are bounded, so at most `queue_size` inputs and `queue_size`
+results are held in memory. The time spent in every stage is reported at the end.
+'''
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+import logging
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+_DONE = object()
+
+
+class InferencePipeline(object):
+    """
+    Overlaps input loading, prediction and result writing.
+
+    Usage:
+    pipeline = InferencePipeline(predictor, load, write, threshold=0.5)
+    timing = pipeline.run(patients)
+
+    :param predictor: unet.Predictor with a restored checkpoint
+    :param load: function(item) returning the network input of one item. Shape [slices, nx, ny, channels]
+    :param write: function(item, prediction) storing the prediction of one item
+    :param batch_size: (optional) slices per session run, default: the whole volume
+    :param threshold: (optional) predictions are masks probability > threshold, default: probabilities
+    :param queue_size: (optional) maximum number of items waiting between two stages, default=2
+    :param writers: (optional) number of writer threads, default=2
+    """
+
+    def __init__(self, predictor, load, write, batch_size=None, threshold=None, queue_size=2, writers=2):
+        self.predictor = predictor
+        self.load = load
+        self.write = write
+        self.batch_size = batch_size
+        self.threshold = threshold
+        self.queue_size = queue_size
+        self.writers = writers
+
+    def _put(self, load_queue, task, stop_event):
+        # gives up once run() stopped taking inputs, e.g. after a failed write
+        while not stop_event.is_set():
+            try:
+                load_queue.put(task, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _load_items(self, items, load_queue, timing, stop_event):
+        try:
+            for item in items:
+                if stop_event.is_set():
+                    return
+                start = time.time()
+                data = self.load(item)
+                timing['load'] += time.time() - start
+                if not self._put(load_queue, (item, data), stop_event):
+                    return
+        except Exception as e:
+            # the loader ends here, run() raises the exception when it reaches it in the queue
+            self._put(load_queue, e, stop_event)
+            return
+        self._put(load_queue, _DONE, stop_event)
+
+    def _write_items(self, write_queue, timing, errors, lock):
+        while True:
+            task = write_queue.get()
+            if task is _DONE:
+                return
+            if errors:
+                continue
+            start = time.time()
+            try:
+                self.write(*task)
+            except Exception as e:
+                errors.append(e)
+            with lock:
+                timing['write'] += time.time() - start
+
+    def run(self, items):
+        """
+        Predicts all items
+
+        :param items: items passed to `load` and `write`, e.g. patient ids
+        :returns timing: seconds spent per stage. 'load' and 'write' are summed over
+            their threads, 'wait' is the time the session waited for input
+        """
+        timing = {'load': 0., 'predict': 0., 'write': 0., 'wait': 0., 'total': 0.}
+        load_queue = queue.Queue(maxsize=self.queue_size)
+        write_queue = queue.Queue(maxsize=self.queue_size)
+        errors = []
+        lock = threading.Lock()
+        stop_event = threading.Event()
+        start_total = time.time()
+
+        loader = threading.Thread(target=self._load_items, args=(items, load_queue, timing, stop_event))
+        loader.daemon = True
+        loader.start()
+        writers = []
+        for _ in range(self.writers):
+            writer = threading.Thread(target=self._write_items, args=(write_queue, timing, errors, lock))
+            writer.daemon = True
+            writer.start()
+            writers.append(writer)
+
+        try:
+            while not errors:
+                start = time.time()
+                task = load_queue.get()
+                timing['wait'] += time.time() - start
+                if task is _DONE:
+                    break
+                if isinstance(task, Exception):
+                    raise task
+
+                item, data = task
+                start = time.time()
+                prediction = self.predictor.predict_volume(data, self.batch_size, self.threshold)
+                timing['predict'] += time.time() - start
+                write_queue.put((item, prediction))
+        finally:
+            # the loader may still be loading or waiting on the full queue, e.g. after a failed write
+            stop_event.set()
+            loader.join()
+            for _ in writers:
+                write_queue.put(_DONE)
+            for writer in writers:
+                writer.join()
+        if errors:
+            raise errors[0]
+
+        timing['total'] = time.time() - start_total
+        logging.info("Load {load:.2f} s, predict {predict:.2f} s (waited {wait:.2f} s for input), "
+                     "write {write:.2f} s, total {total:.2f} s".format(**timing))
+        return timing
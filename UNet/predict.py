@@ -1,8 +1,4 @@
 from __future__ import division, print_function
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib
 import numpy as np
 import os
 import tensorflow as tf
@@ -10,8 +6,15 @@ import logging
 
 import image_gen
 import unet
+import pipeline
+import preview
 import util
 from parameter import Parameter
+from volume_store import VolumeStore
+import sys
+sys.path.append(sys.path[0]+'/../evaluation')
+from mask_io import save_mask
+from resize import resize
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
 
@@ -19,51 +22,67 @@ para = Parameter()
 root_address = para.root_address
 data_address = os.path.join(root_address, 'data/test')
 prediction_save_address = os.path.join(root_address, 'result/pre_image')
+voxel_save_address = os.path.join(root_address, 'result/pre_voxel')
 unet_model_path = os.path.join(root_address, 'result/unet_trained/model.ckpt/_99')
 provider_path = os.path.join(root_address, 'data/test/*/*/*.npy')
 
-if not os.path.exists(prediction_save_address):
+# pre_image only holds the optional slice files and previews
+write_slices = para.save_slices or para.preview
+if write_slices and not os.path.exists(prediction_save_address):
     os.mkdir(prediction_save_address)
+if not os.path.exists(voxel_save_address):
+    os.mkdir(voxel_save_address)
 
 patient_pre_list = []
 patient_label_list = []
 patient_save_list = []
-for addr in os.listdir(data_address):     #addr:01
-
-	image_pre_list = []
-	image_label_list = []
-	image_save_list = []
-
-	patient_addr = os.path.join(data_address, addr)     #data/test/01
-	patient_save_addr = os.path.join(prediction_save_address, addr)    #pre_image/01
-	if not os.path.exists(patient_save_addr):
-		os.mkdir(patient_save_addr)
-
-	for addr_1 in os.listdir(patient_addr):     #addr_1:0
-		image_addr = os.path.join(patient_addr, addr_1)   #data/test/01/0
-		images_save_addr = os.path.join(patient_save_addr, addr_1)   #pre_image/01/0
-		if not os.path.exists(images_save_addr):
-			os.mkdir(images_save_addr)
-
-		for filename in os.listdir(image_addr):
-			if 'fat.npy' in filename:
-				image_pre_list.append(os.path.join(image_addr, filename))     #data/test/01/0/.._fat.npy
-				image_save_list.append(os.path.join(images_save_addr, filename).replace('.npy', '_pre.npy'))   #pre_image01/0/.._fat_pre.npy
-			if 'label.npy' in filename:
-				image_label_list.append(os.path.join(image_addr, filename)) #data/test/01/0/.._label.npy
-
-	patient_pre_list.append(image_pre_list)
-	patient_label_list.append(image_label_list)
-	patient_save_list.append(image_save_list)
+if para.volume_store:
+    # one entry per slice of the store, predictions keep the pre_image/01/0/01_0_fat_pre.npy layout
+    store = VolumeStore(os.path.join(root_address, 'data/test_store'), para.modalities)
+    for addr in store.patients:
+        image_pre_list = []
+        image_save_list = []
+        for index in range(store.n_slices(addr)):
+            images_save_addr = os.path.join(prediction_save_address, addr, '{}'.format(index))
+            image_pre_list.append((addr, index))
+            image_save_list.append(os.path.join(images_save_addr, '{}_{}_fat_pre.npy'.format(addr, index)))
+        patient_pre_list.append(image_pre_list)
+        patient_save_list.append(image_save_list)
+else:
+    for addr in sorted(os.listdir(data_address)):     #addr:01
+
+        image_pre_list = []
+        image_label_list = []
+        image_save_list = []
+
+        patient_addr = os.path.join(data_address, addr)     #data/test/01
+        patient_save_addr = os.path.join(prediction_save_address, addr)    #pre_image/01
+
+        for addr_1 in sorted(os.listdir(patient_addr), key=int):     #addr_1:0, slices in volume order
+            image_addr = os.path.join(patient_addr, addr_1)   #data/test/01/0
+            images_save_addr = os.path.join(patient_save_addr, addr_1)   #pre_image/01/0
+
+            for filename in os.listdir(image_addr):
+                if 'fat.npy' in filename:
+                    image_pre_list.append(os.path.join(image_addr, filename))     #data/test/01/0/.._fat.npy
+                    image_save_list.append(os.path.join(images_save_addr, filename).replace('.npy', '_pre.npy'))   #pre_image01/0/.._fat_pre.npy
+                if 'label.npy' in filename:
+                    image_label_list.append(os.path.join(image_addr, filename)) #data/test/01/0/.._label.npy
+
+        patient_pre_list.append(image_pre_list)
+        patient_label_list.append(image_label_list)
+        patient_save_list.append(image_save_list)
 
 print('start to predict')
-if para.channel == 1:
-    generator = image_gen.oneChannelProvider(provider_path)
-elif para.channel == 4:
-    generator = image_gen.fourChannelProvider(provider_path)
-elif para.channel == 8:
-    generator = image_gen.eightChannelProvider(provider_path)
-
+if para.volume_store:
+    generator = image_gen.volumeChannelProvider(os.path.join(root_address, 'data/test_store'), para.modalities,
+                                                window=para.slice_window, edge=para.slice_edge, shuffle_data=False)
+else:
+    generator = image_gen.ModalityProvider(provider_path, para.modalities, window=para.slice_window,
+                                           edge=para.slice_edge)
+
+# the preview processes are forked before the session exists
+previews = preview.PreviewWriter(para.preview, para.preview_workers)
 net = unet.Unet(channels=generator.channels, n_class=generator.n_class, cost = para.cost,
                 cost_kwargs=dict(regularizer=para.regularizer), layers=para.layers, 
                 features_root=para.features_root, training=False)
@@ -82,94 +101,35 @@ def process_labels(label):
     labels[..., 0] = ~label
     return labels
 
-init = tf.global_variables_initializer()
-config = tf.ConfigProto()
-config.gpu_options.allow_growth = True
-with tf.Session(config=config) as sess:
-    # Initialize variables
-    sess.run(init)
-
-    # Restore model weights from previously saved model
-    net.restore(sess, unet_model_path)
-
-    for i in range(len(patient_pre_list)):
-        print('predict on {}'.format(patient_pre_list[i][0]))
-        for j in range(len(patient_pre_list[i])):
-            if generator.channels==1:
-                path = patient_pre_list[i][j]
-                fat_path = path.replace("fat", "inn")
-                fat_img = np.array(np.load(fat_path), dtype=np.float32)
-                img_arr = np.zeros((fat_img.shape[0], fat_img.shape[1], 1), dtype=np.float32)
-                
-                img_arr[...,0] = fat_img
-                x_test = img_arr.reshape(1, img_arr.shape[0], img_arr.shape[1], generator.channels)
-                y_dummy = np.empty((x_test.shape[0], x_test.shape[1], x_test.shape[2], 2))
-                prediction = sess.run(net.predicter, feed_dict={net.x: x_test, net.y: y_dummy, net.keep_prob: 1.})
-                mask = prediction[0,...,1] > para.mask
-                #mask = prediction[0,...,1]
-                np.save(patient_save_list[i][j], mask)
-                plt.imshow(mask, cmap='gray')
-                plt.savefig(patient_save_list[i][j].replace('.npy', '.png'))
-            elif generator.channels==4:
-                path = patient_pre_list[i][j]
-                fat_path = path.replace("fat", "fat")
-                inn_path = path.replace("fat", "inn")
-                wat_path = path.replace("fat", "wat")
-                opp_path = path.replace("fat", "opp")
-                fat_img = np.array(np.load(fat_path), dtype=np.float32)
-                inn_img = np.array(np.load(inn_path), dtype=np.float32)
-                wat_img = np.array(np.load(wat_path), dtype=np.float32)
-                opp_img = np.array(np.load(opp_path), dtype=np.float32)
-                img_arr = np.zeros((fat_img.shape[0], fat_img.shape[1], 4), dtype=np.float32)
-                
-                img_arr[...,0] = fat_img
-                img_arr[...,1] = inn_img
-                img_arr[...,2] = wat_img
-                img_arr[...,3] = opp_img
-
-                #img_arr = process_data(img_arr)
-                x_test = img_arr.reshape(1, img_arr.shape[0], img_arr.shape[1], generator.channels)
-                y_dummy = np.empty((x_test.shape[0], x_test.shape[1], x_test.shape[2], 2))
-                prediction = sess.run(net.predicter, feed_dict={net.x: x_test, net.y: y_dummy, net.keep_prob: 1.})
-                mask = prediction[0,...,1] > para.mask
-                #mask = prediction[0,...,1]
-                np.save(patient_save_list[i][j], mask)
-                plt.imshow(mask, cmap='gray')
-                plt.savefig(patient_save_list[i][j].replace('.npy', '.png'))
-            elif generator.channels==8:
-                path = patient_pre_list[i][j]
-                fat_path = path.replace("fat", "fat")
-                inn_path = path.replace("fat", "inn")
-                wat_path = path.replace("fat", "wat")
-                opp_path = path.replace("fat", "opp")
-                fin_path = path.replace("fat", "fin")
-                win_path = path.replace("fat", "win")
-                wop_path = path.replace("fat", "wop")
-                iop_path = path.replace("fat", "iop")
-                fat_img = np.array(np.load(fat_path), dtype=np.float32)
-                inn_img = np.array(np.load(inn_path), dtype=np.float32)
-                wat_img = np.array(np.load(wat_path), dtype=np.float32)
-                opp_img = np.array(np.load(opp_path), dtype=np.float32)
-                fin_img = np.array(np.load(fin_path), dtype=np.float32)
-                win_img = np.array(np.load(win_path), dtype=np.float32)
-                wop_img = np.array(np.load(wop_path), dtype=np.float32)
-                iop_img = np.array(np.load(iop_path), dtype=np.float32)
-                img_arr = np.zeros((fat_img.shape[0], fat_img.shape[1], 8), dtype=np.float32)
-                
-                img_arr[...,0] = fat_img
-                img_arr[...,1] = inn_img
-                img_arr[...,2] = wat_img
-                img_arr[...,3] = opp_img
-                img_arr[...,4] = fin_img
-                img_arr[...,5] = win_img
-                img_arr[...,6] = wop_img
-                img_arr[...,7] = iop_img
-
-                x_test = img_arr.reshape(1, img_arr.shape[0], img_arr.shape[1], generator.channels)
-                y_dummy = np.empty((x_test.shape[0], x_test.shape[1], x_test.shape[2], 2))
-                prediction = sess.run(net.predicter, feed_dict={net.x: x_test, net.y: y_dummy, net.keep_prob: 1.})
-                mask = prediction[0,...,1] > para.mask
-                #mask = prediction[0,...,1]
-                np.save(patient_save_list[i][j], mask)
-                plt.imshow(mask, cmap='gray')
-                plt.savefig(patient_save_list[i][j].replace('.npy', '.png'))
\ No newline at end of file
+def load_patient(i):
+    # network input of the patient. Shape [slices, H, W, channels]
+    if para.volume_store:
+        return np.stack([store.window(patient, index, para.slice_window, para.slice_edge)
+                         for patient, index in patient_pre_list[i]])
+    return image_gen.read_modality_volume(patient_pre_list[i], para.modalities, window=para.slice_window,
+                                          edge=para.slice_edge)
+
+def write_patient(i, masks):
+    # the mask volume goes straight to pre_voxel/01/pre.npy (bit packed, see mask_io), slice files are optional
+    patient = os.path.basename(os.path.dirname(os.path.dirname(patient_save_list[i][0])))
+    if not os.path.exists(os.path.join(voxel_save_address, patient)):
+        os.mkdir(os.path.join(voxel_save_address, patient))
+    # e.g. the masks of a 512 or 128 model on the 256 ground truth grid
+    voxel = resize(masks, (para.voxel_size, para.voxel_size))
+    save_mask(os.path.join(voxel_save_address, patient, 'pre.npy'), voxel, compress=para.mask_rle)
+    for j, mask in enumerate(masks):
+        if write_slices and not os.path.exists(os.path.dirname(patient_save_list[i][j])):
+            os.makedirs(os.path.dirname(patient_save_list[i][j]))
+        if para.save_slices:
+            save_mask(patient_save_list[i][j], mask, compress=para.mask_rle)
+        previews(mask, patient_save_list[i][j].replace('.npy', '.png'))
+    print('predicted {}'.format(patient_pre_list[i][0]))
+
+# Restore model weights from previously saved model
+with unet.Predictor(net, unet_model_path) as predictor:
+    # loading the next patient, predicting and writing the last one overlap
+    inference = pipeline.InferencePipeline(predictor, load_patient, write_patient,
+                                           batch_size=para.predict_batch_size, threshold=para.mask,
+                                           queue_size=para.pipeline_queue_size, writers=para.pipeline_writers)
+    inference.run(range(len(patient_pre_list)))
+previews.close()
@@ -0,0 +1,98 @@
+'''
+Asynchronous PNG previews.
+
+Previews are written straight from the arrays with PIL in a process pool, so
+the conversion and prediction loops only hand the array over. A disabled
+PreviewWriter does nothing and starts no processes.
+
+Usage:
+with PreviewWriter(enabled=para.preview) as previews:
+    previews(mask, 'pre_image/01/0/01_0_fat_pre.png')
+'''
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+from collections import deque
+from multiprocessing import Pool
+import threading
+import numpy as np
+from PIL import Image
+
+
+def to_uint8(img):
+    """
+    Scales an image to 0..255 between its min and max, like imshow with a grey colormap
+    """
+    img = np.asarray(img, dtype=np.float32)
+    img_min = img.min()
+    img_range = img.max() - img_min
+    if img_range == 0:
+        return np.zeros(img.shape, dtype=np.uint8)
+    return ((img - img_min) * (255. / img_range)).round().astype(np.uint8)
+
+
+def save_png(job):
+    img, path = job
+    # uint8 arrays, e.g. RGB overlays, are written as they are
+    if img.dtype != np.uint8:
+        img = to_uint8(img)
+    Image.fromarray(img).save(path, 'PNG')
+
+
+class PreviewWriter(object):
+    """
+    Writes grey scale PNG previews in a process pool. Calls from several threads,
+    e.g. the writer threads of the InferencePipeline, are safe.
+
+    :param enabled: (optional) if False all calls are no-ops, default=True
+    :param workers: (optional) number of rendering processes, default=2
+    :param max_pending: (optional) previews in flight before the caller waits, default=64
+    """
+
+    def __init__(self, enabled=True, workers=2, max_pending=64):
+        self.enabled = enabled
+        self.max_pending = max_pending
+        self._pending = deque()
+        self._lock = threading.Lock()
+        self._pool = Pool(workers) if enabled else None
+
+    def __call__(self, img, path):
+        """
+        Queues the preview of a 2D array
+
+        :param img: image or mask, scaled to 0..255 unless it is uint8. Shape [nx, ny] or [nx, ny, 3]
+        :param path: target .png file
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            self._pending.append(self._pool.apply_async(save_png, ((img, path),)))
+            overflow = [self._pending.popleft() for _ in range(len(self._pending) - self.max_pending)]
+        # waited for outside the lock, the other threads keep queueing meanwhile
+        for result in overflow:
+            result.get()
+
+    def wait(self):
+        """
+        Blocks until all queued previews are written
+        """
+        while True:
+            with self._lock:
+                if not self._pending:
+                    return
+                result = self._pending.popleft()
+            result.get()
+
+    def close(self):
+        if self._pool is None:
+            return
+        self.wait()
+        self._pool.close()
+        self._pool.join()
+        self._pool = None
+        self.enabled = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -10,6 +10,8 @@ import logging
 plt.rcParams['image.cmap'] = 'gist_earth'
 
 import image_gen
+import image_util
+import dataset
 import unet
 import util
 from parameter import Parameter
@@ -20,12 +22,35 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
 para = Parameter()
 root_address = para.root_address
 generator_address = os.path.join(root_address, 'data/train/*/*/*.npy')
-if para.channel == 1:
-    generator = image_gen.oneChannelProvider(generator_address)
-elif para.channel == 4:
-    generator = image_gen.fourChannelProvider(generator_address)
-elif para.channel == 8:
-    generator = image_gen.eightChannelProvider(generator_address)
+if para.volume_store:
+    generator = image_gen.volumeChannelProvider(os.path.join(root_address, 'data/train_store'), para.modalities,
+                                                window=para.slice_window, edge=para.slice_edge)
+else:
+    generator = image_gen.ModalityProvider(generator_address, para.modalities, window=para.slice_window,
+                                           edge=para.slice_edge)
+if para.sample_cache_mb > 0:
+    generator.cache = image_util.SampleCache(para.sample_cache_mb * 2**20)
+if para.RMVD:
+    # a sample keeps all modalities with probability RMVD_value
+    generator.rmvd_rate = 1 - para.RMVD_value
+    if para.RMVD_seed is not None:
+        generator.seed(para.RMVD_seed)
+if para.tf_data:
+    # the batches come from a tf.data pipeline built inside the unet graph
+    if hasattr(generator, 'data_files'):
+        input_fn = lambda: dataset.file_dataset(generator, para.batch_size, num_parallel_calls=para.tf_data_parallel,
+                                                prefetch=para.prefetch_queue_size, cache=para.tf_data_cache)
+    else:
+        input_fn = lambda: dataset.provider_dataset(generator, para.batch_size, prefetch=para.prefetch_queue_size)
+else:
+    input_fn = None
+if para.prefetch and not para.tf_data:
+    if para.prefetch_processes:
+        generator = image_util.MultiprocessDataProvider(generator, para.batch_size, n_workers=para.prefetch_workers,
+                                                        slots=para.prefetch_queue_size, seed=para.RMVD_seed)
+    else:
+        generator = image_util.PrefetchDataProvider(generator, para.batch_size, n_workers=para.prefetch_workers,
+                                                    queue_size=para.prefetch_queue_size)
 
 result_path = os.path.join(root_address, 'result')
 if not os.path.exists(result_path):
@@ -37,7 +62,7 @@ prediction_address = os.path.join(result_path, 'each_epoch')
 
 net = unet.Unet(channels=generator.channels, n_class=generator.n_class, cost = para.cost,
                 cost_kwargs=dict(regularizer=para.regularizer), layers=para.layers, 
-                features_root=para.features_root, training=True)
+                features_root=para.features_root, training=True, input_fn=input_fn)
 
 #trainer = unet.Trainer(net, batch_size=para.batch_size, optimizer="momentum",
 #                       opt_kwargs=dict(momentum=para.momentum, learning_rate=para.learning_rate))
@@ -46,10 +71,13 @@ trainer = unet.Trainer(net, batch_size=para.batch_size, optimizer="adam",
 path = trainer.train(generator, unet_trained_path, training_iters=para.training_iters, 
                      epochs=para.epochs, dropout=para.dropout, display_step=para.display_step, 
                      restore=para.restore, prediction_path=prediction_address)
+if para.prefetch and not para.tf_data:
+    generator.stop()
 
 #test one image
 x_test, y_test= generator(1)
 prediction = net.predict(os.path.join(unet_trained_path, 'model.ckpt'), x_test)
+net.close()
 
 logging.info(
 "Layers: {layers},\nFeatures: {features}\n\
@@ -84,7 +112,7 @@ fo.close()
 
 plt.imshow(x_test[0,...,0], cmap='Greys_r')
 plt.savefig(os.path.join(unet_trained_path, 'image.png'))
-plt.imshow(y_test[0,...,1])
+plt.imshow(y_test[0])
 plt.savefig(os.path.join(unet_trained_path, 'label.png'))
 mask = prediction[0,...,1] > para.mask
 plt.imshow(mask)
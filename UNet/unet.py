@@ -2,6 +2,7 @@ from __future__ import print_function, division, absolute_import, unicode_litera
 
 import os
 import shutil
+import time
 import numpy as np
 from collections import OrderedDict
 import logging
@@ -402,16 +403,27 @@ class Unet(object):
     :param n_class: (optional) number of output labels
     :param cost: (optional) name of the cost function. Default is 'cross_entropy'
     :param cost_kwargs: (optional) kwargs passed to the cost function. See Unet._get_cost for more options
+    :param input_fn: (optional) function returning a tf.data.Dataset of (x, labels) batches, see dataset.py.
+        It is called inside the unet graph and x and labels default to the next batch of the dataset
     """
 
-    def __init__(self, channels=3, n_class=2, cost="cross_entropy", cost_kwargs={}, **kwargs):
+    def __init__(self, channels=3, n_class=2, cost="cross_entropy", cost_kwargs={}, input_fn=None, **kwargs):
         tf.reset_default_graph()
 
         self.n_class = n_class
         self.summaries = kwargs.get("summaries", True)
 
-        self.x = tf.placeholder("float", shape=[None, None, None, channels], name="x")
-        self.y = tf.placeholder("float", shape=[None, None, None, n_class], name="y")
+        # labels are fed as uint8 class indices, the one-hot labels are built in-graph
+        self.from_dataset = input_fn is not None
+        if self.from_dataset:
+            # feeding x and labels still works, e.g. for the verification batch and predictions
+            batch_x, batch_labels = input_fn().make_one_shot_iterator().get_next()
+            self.x = tf.placeholder_with_default(batch_x, shape=[None, None, None, channels], name="x")
+            self.labels = tf.placeholder_with_default(batch_labels, shape=[None, None, None], name="labels")
+        else:
+            self.x = tf.placeholder("float", shape=[None, None, None, channels], name="x")
+            self.labels = tf.placeholder(tf.uint8, shape=[None, None, None], name="labels")
+        self.y = tf.one_hot(tf.cast(self.labels, tf.int32), n_class, name="y")
         self.keep_prob = tf.placeholder(tf.float32, name="dropout_probability")  # dropout (keep probability)
 
         logits, self.variables= create_conv_net_edge(self.x, self.keep_prob, channels, n_class, **kwargs)
@@ -442,10 +454,10 @@ class Unet(object):
             flat_labels = tf.reshape(self.y, [-1, self.n_class])
             if cost_name == 'CE':
                 loss = 0
-                flat_label = tf.reshape(self.y, [-1, self.n_class])
+                flat_label = tf.reshape(tf.cast(self.labels, tf.int32), [-1])
                 for logit in logits:
                     flat_logit = tf.reshape(logit, [-1, self.n_class])
-                    loss += tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits_v2(logits=flat_logit, labels=flat_label))
+                    loss += tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(logits=flat_logit, labels=flat_label))
             elif cost_name == "dice_coefficient":
                 eps = 1e-5
                 prediction = pixel_wise_softmax(logits)
@@ -480,24 +492,49 @@ class Unet(object):
 
     def predict(self, model_path, x_test):
         """
-        Uses the model to create a prediction for the given data
+        Uses the model to create a prediction for the given data. The first call opens a
+        Predictor session that the net owns until `close`
 
         :param model_path: path to the model checkpoint to restore
         :param x_test: Data to predict on. Shape [n, nx, ny, channels]
         :returns prediction: The unet prediction Shape [n, px, py, labels] (px=nx-self.offset/2)
         """
+        # the session stays open between calls, a new model_path only swaps the weights
+        predictor = getattr(self, '_predictor', None)
+        if predictor is None:
+            predictor = self._predictor = Predictor(self)
+        if predictor.model_path != model_path:
+            predictor.restore(model_path)
+        return predictor.predict(x_test)
+
+    def close(self):
+        """
+        Closes the session opened by `predict`, a later call opens a new one
+        """
+        predictor = getattr(self, '_predictor', None)
+        if predictor is not None:
+            predictor.close()
+            self._predictor = None
 
-        init = tf.global_variables_initializer()
-        with tf.Session() as sess:
-            # Initialize variables
-            sess.run(init)
-
-            # Restore model weights from previously saved model
-            self.restore(sess, model_path)
-
-            y_dummy = np.empty((x_test.shape[0], x_test.shape[1], x_test.shape[2], self.n_class))
-            prediction = sess.run(self.predicter, feed_dict={self.x: x_test, self.y: y_dummy, self.keep_prob: 1.})
+    def predict_volume(self, sess, volume, batch_size=None, threshold=None):
+        """
+        Predicts a whole volume in memory with an open session
 
+        :param sess: session with the restored model
+        :param volume: network input of all slices. Shape [slices, nx, ny, channels]
+        :param batch_size: (optional) slices per run, default: the whole volume in one run
+        :param threshold: (optional) return the mask probability > threshold instead of the probability
+        :returns prediction: foreground probability or mask. Shape [slices, nx, ny]
+        """
+        n_slices = volume.shape[0]
+        batch_size = batch_size or n_slices
+        prediction = np.empty(volume.shape[:3], dtype=np.float32)
+        for start in range(0, n_slices, batch_size):
+            batch = volume[start:start + batch_size]
+            prediction[start:start + batch_size] = sess.run(self.predicter, feed_dict={self.x: batch, self.keep_prob: 1.})[..., 1]
+
+        if threshold is not None:
+            return prediction > threshold
         return prediction
 
     def save(self, sess, model_path):
@@ -523,6 +560,63 @@ class Unet(object):
         saver.restore(sess, model_path)
         logging.info("Model restored from file: %s" % model_path)
 
+class Predictor(object):
+    """
+    Long lived inference session of a unet. The graph is built once and the
+    session stays open, so repeated predictions only pay for the forward pass.
+    Restoring another checkpoint swaps the weights in the same session.
+
+    :param net: the unet to predict with
+    :param model_path: (optional) checkpoint to restore right away
+    :param config: (optional) tf.ConfigProto of the session. Default: allow_growth
+    """
+
+    def __init__(self, net, model_path=None, config=None):
+        self.net = net
+        if config is None:
+            config = tf.ConfigProto()
+            config.gpu_options.allow_growth = True
+        self.sess = tf.Session(config=config)
+        # one saver for the whole lifetime, a saver per restore would grow the graph
+        self.saver = tf.train.Saver(tf.global_variables())
+        self.model_path = None
+        if model_path is not None:
+            self.restore(model_path)
+
+    def restore(self, model_path):
+        """
+        Loads the weights of a checkpoint into the open session
+
+        :param model_path: path to file system checkpoint location
+        """
+        self.saver.restore(self.sess, model_path)
+        self.model_path = model_path
+        logging.info("Model restored from file: %s" % model_path)
+
+    def predict(self, x_test):
+        """
+        :param x_test: Data to predict on. Shape [n, nx, ny, channels]
+        :returns prediction: The unet prediction Shape [n, nx, ny, labels]
+        """
+        assert self.model_path is not None, "No checkpoint restored"
+        return self.sess.run(self.net.predicter, feed_dict={self.net.x: x_test, self.net.keep_prob: 1.})
+
+    def predict_volume(self, volume, batch_size=None, threshold=None):
+        """
+        See Unet.predict_volume
+        """
+        assert self.model_path is not None, "No checkpoint restored"
+        return self.net.predict_volume(self.sess, volume, batch_size, threshold)
+
+    def close(self):
+        self.sess.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
 class Trainer(object):
     """
     Trains a unet instance
@@ -620,7 +714,8 @@ class Trainer(object):
         """
         Lauches the training process
 
-        :param data_provider: callable returning training and verification data
+        :param data_provider: callable returning training and verification data. A unet built
+            with `input_fn` only draws the verification data from it
         :param output_path: path where to store checkpoints
         :param training_iters: number of training mini batch iteration
         :param epochs: number of epochs
@@ -649,7 +744,8 @@ class Trainer(object):
                 if ckpt and ckpt.model_checkpoint_path:
                     self.net.restore(sess, ckpt.model_checkpoint_path)
 
-            test_x, test_y = data_provider(self.verification_batch_size)
+            # the provider reuses its batch buffers, keep a copy of the verification batch
+            test_x, test_y = [np.array(a) for a in data_provider(self.verification_batch_size)]
             pred_shape = self.store_prediction(sess, test_x, test_y, "_init")
 
             summary_writer = tf.summary.FileWriter(output_path, graph=sess.graph)
@@ -658,15 +754,31 @@ class Trainer(object):
             avg_gradients = None
             for epoch in range(epochs):
                 total_loss = 0
+                total_wait = 0
                 for step in range((epoch * training_iters), ((epoch + 1) * training_iters)):
-                    batch_x, batch_y = data_provider(self.batch_size)
-
-                    # Run optimization op (backprop)
-                    _, loss, lr, gradients = sess.run(
-                        (self.optimizer, self.net.cost, self.learning_rate_node, self.net.gradients_node),
-                        feed_dict={self.net.x: batch_x,
-                                   self.net.y: batch_y,
-                                   self.net.keep_prob: dropout})
+                    if self.net.from_dataset:
+                        # the batch comes from the dataset iterator inside the graph, it is only
+                        # fetched back when the minibatch stats need it
+                        fetches = (self.optimizer, self.net.cost, self.learning_rate_node, self.net.gradients_node)
+                        if step % display_step == 0:
+                            fetches += (self.net.x, self.net.labels)
+                        results = sess.run(fetches, feed_dict={self.net.keep_prob: dropout})
+                        _, loss, lr, gradients = results[:4]
+                        if step % display_step == 0:
+                            batch_x, batch_y = results[4:]
+                    else:
+                        wait_start = time.time()
+                        batch_x, batch_y = data_provider(self.batch_size)
+                        data_wait = time.time() - wait_start
+                        total_wait += data_wait
+                        self.output_data_wait(summary_writer, step, data_wait)
+
+                        # Run optimization op (backprop)
+                        _, loss, lr, gradients = sess.run(
+                            (self.optimizer, self.net.cost, self.learning_rate_node, self.net.gradients_node),
+                            feed_dict={self.net.x: batch_x,
+                                       self.net.labels: batch_y,
+                                       self.net.keep_prob: dropout})
 
                     if self.net.summaries and self.norm_grads:
                         avg_gradients = _update_avg_gradients(avg_gradients, gradients, step)
@@ -679,6 +791,15 @@ class Trainer(object):
                     total_loss += loss
 
                 self.output_epoch_stats(epoch, total_loss, training_iters, lr)
+                if not self.net.from_dataset:
+                    logging.info("Epoch {:}, Average data wait: {:.2f} ms".format(epoch, 1000 * total_wait / training_iters))
+                if hasattr(data_provider, 'buffer_stats'):
+                    logging.info("Batch buffers: {allocations} allocations ({megabytes:.1f} MB) "
+                                 "for {batches} batches".format(**data_provider.buffer_stats()))
+                cache_stats = data_provider.cache_stats() if hasattr(data_provider, 'cache_stats') else None
+                if cache_stats is not None:
+                    logging.info("Sample cache: {hits} hits, {misses} misses, {evictions} evictions, "
+                                 "{samples} samples ({megabytes:.1f} MB)".format(**cache_stats))
                 self.store_prediction(sess, test_x, test_y, "epoch_%s" % epoch)
 
                 save_path = self.net.save(sess, save_path)
@@ -691,12 +812,12 @@ class Trainer(object):
 
     def store_prediction(self, sess, batch_x, batch_y, name):
         prediction = sess.run(self.net.predicter, feed_dict={self.net.x: batch_x,
-                                                             self.net.y: batch_y,
+                                                             self.net.labels: batch_y,
                                                              self.net.keep_prob: 1.})
         pred_shape = prediction.shape
 
         loss = sess.run(self.net.cost, feed_dict={self.net.x: batch_x,
-                                                  self.net.y: batch_y,
+                                                  self.net.labels: batch_y,
                                                   self.net.keep_prob: 1.})
 
         #logging.info("Verification error= {:.2f}%, loss= {:.6f}".format(error_rate(prediction, batch_y), loss))
@@ -710,6 +831,11 @@ class Trainer(object):
         logging.info(
             "Epoch {:}, Average loss: {:.6f}, learning rate: {:.5f}".format(epoch, (total_loss / training_iters), lr))
 
+    def output_data_wait(self, summary_writer, step, data_wait):
+        # time the training step spent waiting for its batch
+        summary = tf.Summary(value=[tf.Summary.Value(tag="data_wait_ms", simple_value=1000 * data_wait)])
+        summary_writer.add_summary(summary, step)
+
     def output_minibatch_stats(self, sess, summary_writer, step, batch_x, batch_y):
         # Calculate batch loss and accuracy
         summary_str, loss, acc, predictions = sess.run([self.summary_op,
@@ -717,7 +843,7 @@ class Trainer(object):
                                                         self.net.accuracy,
                                                         self.net.predicter],
                                                        feed_dict={self.net.x: batch_x,
-                                                                  self.net.y: batch_y,
+                                                                  self.net.labels: batch_y,
                                                                   self.net.keep_prob: 1.})
         summary_writer.add_summary(summary_str, step)
         summary_writer.flush()
@@ -739,12 +865,12 @@ def _update_avg_gradients(avg_gradients, gradients, step):
 
 def error_rate(predictions, labels):
     """
-    Return the error rate based on dense predictions and 1-hot labels.
+    Return the error rate based on dense predictions and class index labels.
     """
 
     return 100.0 - (
             100.0 *
-            np.sum(np.argmax(predictions, 3) == np.argmax(labels, 3)) /
+            np.sum(np.argmax(predictions, 3) == labels) /
             (predictions.shape[0] * predictions.shape[1] * predictions.shape[2]))
 
 def get_image_summary(img, idx=0):
@@ -35,7 +35,7 @@ def plot_prediction(x_test, y_test, prediction, save=False):
     for i in range(test_size):
         cax = ax[i, 0].imshow(x_test[i])
         plt.colorbar(cax, ax=ax[i,0])
-        cax = ax[i, 1].imshow(y_test[i, ..., 1])
+        cax = ax[i, 1].imshow(y_test[i])
         plt.colorbar(cax, ax=ax[i,1])
         pred = prediction[i, ..., 1]
         pred -= np.amin(pred)
@@ -91,7 +91,7 @@ def combine_img_prediction(data, gt, pred):
     Combines the data, grouth thruth and the prediction into one rgb image
     
     :param data: the data tensor
-    :param gt: the ground thruth tensor
+    :param gt: the ground thruth class indices
     :param pred: the prediction tensor
     
     :returns img: the concatenated rgb image 
@@ -102,7 +102,7 @@ def combine_img_prediction(data, gt, pred):
     ny = pred.shape[2]
     ch = data.shape[3]
     img = np.concatenate((to_rgb(data.reshape(-1, ny, ch)), 
-                          to_rgb(gt[..., 1].reshape(-1, ny, 1)), 
+                          to_rgb(gt.reshape(-1, ny, 1).astype(np.float32)), 
                           to_rgb(pred[..., 1].reshape(-1, ny, 1))), axis=1)
     return img
 
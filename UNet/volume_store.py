@@ -0,0 +1,196 @@
+'''
+Per-patient volume store.
+
+Each patient is kept as one contiguous `(slices, H, W, modalities)` image
+array and one `(slices, H, W)` uint8 label array, described by a small
+`index.json`:
+
+    store/index.json
+    store/01/image.npy
+    store/01/label.npy
+
+Arrays are opened with `np.load(..., mmap_mode='r')`, so a training sample is
+a view into the memory map instead of one file per slice and modality.
+2.5D inputs are built on the fly from the same volume with `window`.
+'''
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+import json
+import os
+import numpy as np
+
+INDEX_NAME = 'index.json'
+IMAGE_NAME = 'image.npy'
+LABEL_NAME = 'label.npy'
+EDGE_MODES = ('replicate', 'reflect', 'zero')
+
+
+def write_patient(store_path, patient, image, label, modalities, dtype=np.float32):
+    """
+    Writes the volumes of one patient into the store and registers them in the index
+
+    :param store_path: root directory of the store
+    :param patient: patient id, e.g. '01'
+    :param image: image volume. Shape [slices, H, W, modalities]
+    :param label: label volume. Shape [slices, H, W]
+    :param modalities: names of the modalities in the last axis of `image`
+    :param dtype: (optional) dtype of the stored image, default=float32
+    """
+    assert image.shape[:3] == label.shape, "Image and label shape differ"
+    assert image.shape[3] == len(modalities), "Wrong number of modalities"
+
+    patient_path = os.path.join(store_path, patient)
+    if not os.path.exists(patient_path):
+        os.makedirs(patient_path)
+
+    np.save(os.path.join(patient_path, IMAGE_NAME), np.ascontiguousarray(image, dtype=dtype))
+    np.save(os.path.join(patient_path, LABEL_NAME), (label > 0).astype(np.uint8))
+
+    index = _read_index(store_path)
+    if index['modalities'] and index['modalities'] != list(modalities):
+        raise ValueError("Store modalities %s do not match %s" % (index['modalities'], list(modalities)))
+    index['modalities'] = list(modalities)
+    index['patients'][patient] = {'shape': list(image.shape), 'dtype': np.dtype(dtype).name}
+    with open(os.path.join(store_path, INDEX_NAME), 'w') as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+
+
+def window_indices(n_slices, index, width, edge='replicate'):
+    """
+    Slice indices of the `width` wide neighbourhood around `index`
+
+    :param n_slices: number of slices in the volume
+    :param index: center slice
+    :param width: odd number of slices in the window
+    :param edge: how to fill the window at the volume border. 'replicate' repeats the
+        border slice, 'reflect' mirrors the volume at the border, 'zero' uses empty slices
+    :returns indices: array of slice indices, -1 marks an empty slice
+    """
+    assert width % 2 == 1, "Window width has to be odd"
+    if edge not in EDGE_MODES:
+        raise ValueError("Unknown edge mode: %s" % edge)
+
+    indices = np.arange(index - width // 2, index + width // 2 + 1)
+    if edge == 'replicate':
+        indices = np.clip(indices, 0, n_slices - 1)
+    elif edge == 'reflect':
+        period = 2 * (n_slices - 1) if n_slices > 1 else 1
+        indices = np.abs(indices) % period
+        indices = np.where(indices >= n_slices, period - indices, indices)
+    else:
+        indices[(indices < 0) | (indices >= n_slices)] = -1
+    return indices
+
+
+def _read_index(store_path):
+    index_path = os.path.join(store_path, INDEX_NAME)
+    if not os.path.exists(index_path):
+        return {'modalities': [], 'patients': {}}
+    with open(index_path) as f:
+        return json.load(f)
+
+
+class VolumeStore(object):
+    """
+    Read access to a volume store. Volumes are memory mapped on first use.
+
+    :param store_path: root directory of the store
+    :param modalities: (optional) modalities to read, in channel order. Default: all stored modalities
+    """
+
+    def __init__(self, store_path, modalities=None):
+        self.store_path = store_path
+        index = _read_index(store_path)
+        assert len(index['patients']) > 0, "Empty volume store: %s" % store_path
+
+        self.stored_modalities = index['modalities']
+        self.modalities = list(modalities) if modalities is not None else list(self.stored_modalities)
+        for modality in self.modalities:
+            if modality not in self.stored_modalities:
+                raise ValueError("Modality '%s' not in store %s" % (modality, store_path))
+
+        # reading every stored modality in stored order keeps samples zero-copy
+        self._channel_idx = [self.stored_modalities.index(m) for m in self.modalities]
+        if self._channel_idx == list(range(len(self.stored_modalities))):
+            self._channel_idx = None
+
+        self.patients = sorted(index['patients'])
+        self.shapes = dict((p, tuple(index['patients'][p]['shape'])) for p in self.patients)
+        self.channels = len(self.modalities)
+        self._images = {}
+        self._labels = {}
+
+    def __getstate__(self):
+        # a copy for another process maps the volumes itself instead of pickling their data
+        state = self.__dict__.copy()
+        state['_images'] = {}
+        state['_labels'] = {}
+        return state
+
+    def n_slices(self, patient):
+        return self.shapes[patient][0]
+
+    def samples(self):
+        """
+        All (patient, slice index) pairs of the store
+        """
+        return [(p, i) for p in self.patients for i in range(self.n_slices(p))]
+
+    def image(self, patient):
+        """
+        Memory mapped image volume of a patient. Shape [slices, H, W, stored modalities]
+        """
+        if patient not in self._images:
+            path = os.path.join(self.store_path, patient, IMAGE_NAME)
+            self._images[patient] = np.load(path, mmap_mode='r')
+        return self._images[patient]
+
+    def label(self, patient):
+        """
+        Memory mapped label volume of a patient. Shape [slices, H, W]
+        """
+        if patient not in self._labels:
+            path = os.path.join(self.store_path, patient, LABEL_NAME)
+            self._labels[patient] = np.load(path, mmap_mode='r')
+        return self._labels[patient]
+
+    def slice(self, patient, index):
+        """
+        Image of one slice with the selected modalities. Shape [H, W, channels]
+        """
+        img = self.image(patient)[index]
+        if self._channel_idx is not None:
+            img = img[..., self._channel_idx]
+        return img
+
+    def window(self, patient, index, width=1, edge='replicate'):
+        """
+        2.5D input of one slice: the `width` neighbouring slices of every selected
+        modality, modality major (fat[-1], fat[0], fat[+1], inn[-1], ...).
+        Shape [H, W, channels * width]. A width of 1 returns the view of `slice`.
+
+        :param patient: patient id
+        :param index: center slice
+        :param width: (optional) odd number of slices per modality, default=1
+        :param edge: (optional) border handling, see `window_indices`. Default 'replicate'
+        """
+        if width == 1:
+            return self.slice(patient, index)
+
+        img = self.image(patient)
+        indices = window_indices(img.shape[0], index, width, edge)
+        stack = img[np.maximum(indices, 0)]          # [width, H, W, stored modalities]
+        if self._channel_idx is not None:
+            stack = stack[..., self._channel_idx]
+        stack[indices < 0] = 0
+        stack = stack.transpose(1, 2, 3, 0)          # [H, W, channels, width]
+        return stack.reshape(stack.shape[0], stack.shape[1], -1)
+
+    def volume(self, patient):
+        """
+        Image volume of a patient with the selected modalities. Shape [slices, H, W, channels]
+        """
+        img = self.image(patient)
+        if self._channel_idx is not None:
+            img = img[..., self._channel_idx]
+        return img
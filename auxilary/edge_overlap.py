@@ -5,60 +5,40 @@ import matplotlib.pyplot as plt
 import numpy as np
 import os
 import scipy.ndimage.measurements as mear
+import sys
+sys.path.append(sys.path[0]+'/../evaluation')
 from Dice import Dice_3D, MDOC, SDDOC
-from skimage import measure
+from postprocess import filter_regions
+from mask_io import load_mask
 
 label_address = '/DATA5_DB8/data/sxfeng/data/IVDNet/experiment/8modality/data/test_npydata'
 pre_address = '/DATA5_DB8/data/sxfeng/data/IVDNet/experiment/8modality/result/pre_voxel'
 save_address = '/DATA/data/sxfeng/Program/ensemble/edge'
 
-def _find_contour(label_arr, contour_arr, a):
-    s = set()
-    nx = label_arr.shape[0]
-    ny = label_arr.shape[1]
-    for tmp in contour_arr:
-        for x, y in tmp:
-            x = int(x)
-            y = int(y)
-            if x+1 < nx:
-                if label_arr[x+1, y] == a:
-                    s.add((x+1, y))
-            if x-1 >= 0:
-                if label_arr[x-1, y] == a:
-                    s.add((x-1, y))
-            if y+1 < ny:
-                if label_arr[x, y+1] == a:
-                    s.add((x, y+1))
-            if y-1 >= 0:
-                if label_arr[x, y-1] == a:
-                    s.add((x, y-1))
-    #print(len(s))
-    return s
+def boundary(mask):
+    """
+    In-plane boundary of a mask: foreground pixels with a background 4-neighbour
+    in the same slice. Pixels on the border of the array count as inside.
 
-def _del_small_rigion(voxel):
-    #for gt voxel, find the top 7 rigions and delete others
-    voxel, num = mear.label(voxel)
+    :param mask: boolean volume, e.g. the crop of one disc. Shape [slices, nx, ny]
+    :returns edge: boolean volume of the boundary pixels
+    """
+    interior = mask.copy()
+    interior[:, 1:, :] &= mask[:, :-1, :]
+    interior[:, :-1, :] &= mask[:, 1:, :]
+    interior[:, :, 1:] &= mask[:, :, :-1]
+    interior[:, :, :-1] &= mask[:, :, 1:]
+    return mask & ~interior
 
-    num_per_rigion = dict()
-    for i in range(1, num+1):
-        tmp_arr = np.where(voxel==i)
-        num_per_rigion[i] = len(tmp_arr[0])
-
-    d = sorted(num_per_rigion.items(), key= lambda x:x[1], reverse=True)
-    index_lsit = []
-    for i in range(7):
-        index_lsit.append(d[i][0])
-    for i in range(1, num+1):
-        if not i in index_lsit:  # small region
-            tmp_arr = np.where(voxel==i)
-            for i in range(len(tmp_arr[0])):
-                voxel[tmp_arr[0][i], tmp_arr[1][i], tmp_arr[2][i]] = 0
-        elif i in index_lsit:
-            tmp_arr = np.where(voxel==i)
-            for i in range(len(tmp_arr[0])):
-                voxel[tmp_arr[0][i], tmp_arr[1][i], tmp_arr[2][i]] = 1
-
-    return voxel
+def edge_overlap(label_mask, pre_mask):
+    """
+    Fraction of the predicted boundary pixels that lie on the label boundary
+    """
+    pre_edge = boundary(pre_mask)
+    pre_count = np.count_nonzero(pre_edge)
+    if pre_count == 0:
+        return 0.
+    return np.count_nonzero(pre_edge & boundary(label_mask)) / pre_count
 
 def single_IVD(voxel):
     voxel, _ = mear.label(voxel)
@@ -85,12 +65,6 @@ def single_IVD(voxel):
         new_range_list.append(gt_IVD_range_list[index])
     return new_range_list
 
-def _addIndex(contour_set, index):
-    new_set = set()
-    for point in contour_set:
-        new_set.add((index, point[0], point[1]))
-    return new_set
-
 
 length_list = []
 overlap_list = []
@@ -102,27 +76,17 @@ for index in os.listdir(pre_address):
     patient_label_addr = os.path.join(patient_label_addr, '{}_Labels.npy'.format(index))
 
     label_voxel = np.load(patient_label_addr)
-    pre_voxel = np.load(patient_pre_addr)
-    range_list = single_IVD(_del_small_rigion(label_voxel))
+    pre_voxel = load_mask(patient_pre_addr)
+    range_list = single_IVD(filter_regions(label_voxel, top_k=7)[0] > 0)
 
     tmp_list = []
     for i in range(7):
         single_range = range_list[i]
         single_label_voxel = label_voxel[:, single_range[0]:single_range[1], single_range[2]:single_range[3]]
         single_pre_voxel = pre_voxel[:, single_range[0]:single_range[1], single_range[2]:single_range[3]]
-        voxel_label_set = set()
-        voxel_pre_set = set()
-        for j in range(36):
-            label_img = single_label_voxel[j]
-            pre_img = single_pre_voxel[j]
-            label_con_set = _find_contour(label_img, measure.find_contours(label_img, 0), 255)
-            pre_con_set = _find_contour(pre_img, measure.find_contours(pre_img, 0), 1)
-            label_con_set = _addIndex(label_con_set, j)
-            pre_con_set = _addIndex(pre_con_set, j)
-            voxel_label_set = voxel_label_set|label_con_set
-            voxel_pre_set = voxel_pre_set|pre_con_set
-        intersection = voxel_pre_set&voxel_label_set
-        tmp_list.append([single_range[4], len(intersection)/len(voxel_pre_set)])
+        # boundaries of all slices of the crop at once
+        overlap = edge_overlap(single_label_voxel == 255, single_pre_voxel == 1)
+        tmp_list.append([single_range[4], overlap])
 
 
     print(tmp_list)
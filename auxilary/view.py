@@ -1,68 +1,73 @@
 from __future__ import division, print_function
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 import numpy as np
 import os
-import scipy.ndimage.measurements as mear
-from Dice import Dice_3D, MDOC, SDDOC
-from skimage import measure
+import sys
+sys.path.append(sys.path[0]+'/../evaluation')
+sys.path.append(sys.path[0]+'/..')
+from mask_io import load_mask
+from UNet.preview import PreviewWriter
 
 #label_address = '/DATA5_DB8/data/sxfeng/data/IVDNet/experiment/010611_1/data/test_npydata'
 #pre_address = '/DATA5_DB8/data/sxfeng/data/IVDNet/experiment/512-010611-IVD/result/pre_voxel'
 label_address = '/DATA5_DB8/data/sxfeng/data/IVDNet/experiment/ensemble_IVD/create6_EPE3/5layer/result/pre_voxel'
 pre_address = '/DATA5_DB8/data/sxfeng/data/IVDNet/experiment/ensemble_IVD/create6_EPE3/4layer/result/pre_voxel'
 save_address = '/DATA/data/sxfeng/Program/ensemble/view'
+write_mosaic = False     # one png per patient with all slices instead of one png per slice
+mosaic_cols = 6
+workers = 4
 if not os.path.exists(save_address):
     os.mkdir(save_address)
 
-for index in os.listdir(pre_address):
-    print(index)
-    patient_pre_addr = os.path.join(pre_address, index)
-    patient_pre_addr = os.path.join(patient_pre_addr, 'pre.npy')
-    patient_label_addr = os.path.join(label_address, index)   # pre_voxel/01
-    #patient_label_addr = os.path.join(patient_label_addr, '{}_Labels.npy'.format(index))
-    patient_label_addr = os.path.join(patient_label_addr, 'pre.npy'.format(index))
-    patient_save_addr = os.path.join(save_address, index)   # view/01
-    if not os.path.exists(patient_save_addr):
-        os.mkdir(patient_save_addr)
+def render_overlay(label_voxel, pre_voxel):
+    """
+    RGB overlay of all slices: white background, label magenta, prediction green
+    and pixels in both black
 
-    label_voxel = np.load(patient_label_addr)
-    pre_voxel = np.load(patient_pre_addr)
-    for i in range(36):
-        label_img = label_voxel[i]
-        pre_img = pre_voxel[i]
-        img = np.zeros([256, 256, 3])
-        img[:, :, :] = 100
-        label_arr = np.where(label_img==1)
-        pre_arr = np.where(pre_img==1)
+    :param label_voxel: reference mask. Shape [slices, nx, ny]
+    :param pre_voxel: predicted mask. Shape [slices, nx, ny]
+    :returns img: uint8 volume. Shape [slices, nx, ny, 3]
+    """
+    img = np.full(label_voxel.shape + (3,), 255, dtype=np.uint8)
+    label = label_voxel == 1
+    pre = pre_voxel == 1
+    img[label, 1] = 0
+    img[pre, 0] = 0
+    img[pre, 2] = 0
+    return img
 
+def mosaic(img, cols):
+    """
+    Tiles the slices of an overlay into one image, row by row
 
-        label_len = len(label_arr[0])
-        pre_len = len(pre_arr[0])
-        
-        if not label_len==0:
-            for l in range(label_len):
-                #img[label_arr[0][l], label_arr[1][l], 0] = 0
-                img[label_arr[0][l], label_arr[1][l], 1] = 0
-        '''
-        contours = measure.find_contours(pre_img, 0.5)
-        for tmp in contours:
-            for [x, y] in tmp:
-                #img[int(x), int(y), 0] = 0
-                img[int(x), int(y), 2] = 0
-
-        '''
-        if not pre_len==0:
-            for l in range(pre_len):
-                #img[label_arr[0][l], label_arr[1][l], 0] = 0
-                img[pre_arr[0][l], pre_arr[1][l], 2] = 0
-                img[pre_arr[0][l], pre_arr[1][l], 0] = 0
-
-        save_addr = os.path.join(patient_save_addr, '{}.png'.format(i))     #view/01/0.png
-        plt.imshow(img)
-        plt.savefig(save_addr)
+    :param img: Shape [slices, nx, ny, 3]
+    :returns mosaic: Shape [rows * nx, cols * ny, 3]
+    """
+    slices, nx, ny = img.shape[:3]
+    rows = -(-slices // cols)
+    tiles = np.full((rows * cols, nx, ny, 3), 255, dtype=img.dtype)
+    tiles[:slices] = img
+    return tiles.reshape(rows, cols, nx, ny, 3).transpose(0, 2, 1, 3, 4).reshape(rows * nx, cols * ny, 3)
 
 
+with PreviewWriter(workers=workers) as previews:
+    for index in os.listdir(pre_address):
+        print(index)
+        patient_pre_addr = os.path.join(pre_address, index)
+        patient_pre_addr = os.path.join(patient_pre_addr, 'pre.npy')
+        patient_label_addr = os.path.join(label_address, index)   # pre_voxel/01
+        #patient_label_addr = os.path.join(patient_label_addr, '{}_Labels.npy'.format(index))
+        patient_label_addr = os.path.join(patient_label_addr, 'pre.npy'.format(index))
 
+        label_voxel = load_mask(patient_label_addr)
+        pre_voxel = load_mask(patient_pre_addr)
+        img = render_overlay(label_voxel, pre_voxel)
+        if write_mosaic:
+            previews(mosaic(img, mosaic_cols), os.path.join(save_address, '{}.png'.format(index)))     #view/01.png
+            continue
 
+        patient_save_addr = os.path.join(save_address, index)   # view/01
+        if not os.path.exists(patient_save_addr):
+            os.mkdir(patient_save_addr)
+        for i in range(img.shape[0]):
+            save_addr = os.path.join(patient_save_addr, '{}.png'.format(i))     #view/01/0.png
+            previews(img[i], save_addr)
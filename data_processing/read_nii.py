@@ -1,22 +1,97 @@
 from __future__ import print_function, division
+import hashlib
+import json
+import os
+from multiprocessing import Pool
 import numpy as np
 import nibabel as nib
-import os
 
-data_address = '/DATA/data/sxfeng/data/IVDM3Seg/Training' 
-data_save_address = '/DATA/data/sxfeng/data/IVDM3Seg/npy_data' 
-
-for adr in os.listdir(data_address):
-	patient_adr = os.path.join(data_address, adr)
-	patient_save_adr = os.path.join(data_save_address, adr)
-	if not os.path.exists(patient_save_adr):
-		os.mkdir(patient_save_adr)
-
-	for adr_1 in os.listdir(patient_adr):
-		image_adr = os.path.join(patient_adr, adr_1)
-		img = nib.load(image_adr).get_data()
-		img_max = np.amax(img)
-		img = img/img_max*255.0
-		img_arr = np.asarray(img)
-		image_save_adr = os.path.join(patient_save_adr, adr_1[0:-3] + 'npy')
-		np.save(image_save_adr, img_arr)
\ No newline at end of file
+data_address = '/DATA/data/sxfeng/data/IVDM3Seg/Training'
+data_save_address = '/DATA/data/sxfeng/data/IVDM3Seg/npy_data'
+manifest_address = os.path.join(data_save_address, 'manifest.json')
+image_dtype = 'float16'     # 0-255 images, labels are always stored as uint8
+workers = 8
+
+
+def _file_hash(path):
+	sha = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1 << 20), b''):
+			sha.update(chunk)
+	return sha.hexdigest()
+
+
+def _params(image_adr):
+	# everything besides the input that decides the content of the output
+	dtype = 'uint8' if 'Labels' in os.path.basename(image_adr) else np.dtype(image_dtype).name
+	return {'dtype': dtype, 'scale': 255.0}
+
+
+def _write_manifest(manifest):
+	tmp_address = manifest_address + '.tmp'
+	with open(tmp_address, 'w') as f:
+		json.dump(manifest, f, indent=2, sort_keys=True)
+	os.rename(tmp_address, manifest_address)
+
+
+def convert(job):
+	# convert one .nii unless the manifest says the output is still up to date
+	image_adr, image_save_adr, entry = job
+	stat = os.stat(image_adr)
+	params = _params(image_adr)
+	if (entry is not None and os.path.exists(image_save_adr)
+			and entry.get('params') == params and entry['output'] == image_save_adr):
+		if entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+			return image_adr, entry, False
+		digest = _file_hash(image_adr)
+		if entry['hash'] == digest:
+			entry = dict(entry, size=stat.st_size, mtime=stat.st_mtime)
+			return image_adr, entry, False
+	else:
+		digest = _file_hash(image_adr)
+
+	img = np.asanyarray(nib.load(image_adr).dataobj)
+	img_max = np.amax(img)
+	img = np.multiply(img, params['scale']/img_max, dtype=np.float32)
+	if params['dtype'] == 'uint8':
+		img_arr = np.rint(img).astype(np.uint8)
+	else:
+		img_arr = img.astype(params['dtype'])
+	np.save(image_save_adr, img_arr)
+
+	entry = {'hash': digest, 'size': stat.st_size, 'mtime': stat.st_mtime, 'params': params,
+			 'output': image_save_adr, 'shape': list(img_arr.shape), 'dtype': img_arr.dtype.name}
+	return image_adr, entry, True
+
+
+if __name__ == '__main__':
+	manifest = dict()
+	if os.path.exists(manifest_address):
+		with open(manifest_address) as f:
+			manifest = json.load(f)
+
+	jobs = []
+	for adr in sorted(os.listdir(data_address)):
+		patient_adr = os.path.join(data_address, adr)
+		patient_save_adr = os.path.join(data_save_address, adr)
+		if not os.path.exists(patient_save_adr):
+			os.makedirs(patient_save_adr)
+
+		for adr_1 in sorted(os.listdir(patient_adr)):
+			image_adr = os.path.join(patient_adr, adr_1)
+			image_save_adr = os.path.join(patient_save_adr, adr_1[0:-3] + 'npy')
+			jobs.append((image_adr, image_save_adr, manifest.get(image_adr)))
+
+	pool = Pool(workers)
+	converted = 0
+	for image_adr, entry, changed in pool.imap_unordered(convert, jobs):
+		if entry != manifest.get(image_adr):
+			manifest[image_adr] = entry
+			# written after every volume, an interrupted run keeps what it converted
+			_write_manifest(manifest)
+		if changed:
+			converted += 1
+			print('converted {}'.format(image_adr))
+	pool.close()
+	pool.join()
+	print('{} of {} volumes converted'.format(converted, len(jobs)))
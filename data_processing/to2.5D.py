@@ -1,14 +1,24 @@
 from __future__ import print_function, division
 import numpy as np
 import os
-import matplotlib.pyplot as plt
+
+import sys
+sys.path.append(sys.path[0]+'/..')
+from UNet.preview import PreviewWriter
+
+# Writes the 5 slice stacks [i-1, i, i, i, i+1] to disk, the border slice is repeated
+# at both ends. image_gen.read_modalities (see STACK_OFFSETS) reads slice_window=3 as
+# [i-1, i, i+1], the input the volume store of data_processing/to_volume.py cuts on
+# the fly with slice_window=3 and slice_edge='replicate'. Wider windows need the store.
 
 npy_data_address = '/DATA5_DB8/data/sxfeng/data/IVDM3Seg/npy_data' 
 data_save_address = '/DATA5_DB8/data/sxfeng/data/IVDM3Seg/2D_data/2.5D_12_data' 
 start_index = 0
 end_index = 36
+write_previews = False     # png previews of the labels, rendered in separate processes
 
 Modality = ['fat', 'inn', 'opp', 'wat']
+previews = PreviewWriter(write_previews)
 
 for addr in os.listdir(npy_data_address):
     print('process on {}'.format(addr))
@@ -82,8 +92,7 @@ for addr in os.listdir(npy_data_address):
 
         image_label_arr = voxel_label_arr[index]
         label_save_addr = os.path.join(index_addr, '{}_{}_label.png'.format(addr, index))
-        plt.imshow(image_label_arr, cmap='Greys_r')
-        plt.savefig(label_save_addr)
+        previews(image_label_arr, label_save_addr)
 
         fat_imagearr_save_addr = os.path.join(index_addr, '{}_{}_fat.npy'.format(addr, index))
         inn_imagearr_save_addr = os.path.join(index_addr, '{}_{}_inn.npy'.format(addr, index))
@@ -96,4 +105,5 @@ for addr in os.listdir(npy_data_address):
         np.save(opp_imagearr_save_addr, opp_image_arr_5)
         np.save(wat_imagearr_save_addr, wat_image_arr_5)
         np.save(labelarr_save_addr, image_label_arr)
-        
\ No newline at end of file
+
+previews.close()
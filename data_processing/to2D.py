@@ -1,13 +1,18 @@
 from __future__ import print_function, division
 import numpy as np
 import os
-import matplotlib.pyplot as plt
+
+import sys
+sys.path.append(sys.path[0]+'/..')
+from UNet.preview import PreviewWriter
 
 npy_data_address = '/DATA5_DB8/data/sxfeng/data/IVDM3Seg/npy_data' 
 data_save_address = '/DATA5_DB8/data/sxfeng/data/IVDM3Seg/2D_data/2D_data_inn' 
 start_index = 0
 end_index = 36
+write_previews = False     # png previews of every slice, rendered in separate processes
 
+previews = PreviewWriter(write_previews)
 
 for addr in os.listdir(npy_data_address):
 	print('process on {}'.format(addr))
@@ -60,19 +65,16 @@ for addr in os.listdir(npy_data_address):
 		#wat_imagearr_save_addr = os.path.join(index_addr, '{}_{}_wat.npy'.format(addr, index))
 		labelarr_save_addr = os.path.join(index_addr, '{}_{}_label.npy'.format(addr, index))
 		
-		#plt.imshow(fat_image_arr, cmap='Greys_r')
-		#plt.savefig(fat_image_save_addr)
-		plt.imshow(inn_image_arr, cmap='Greys_r')
-		plt.savefig(inn_image_save_addr)
-		#plt.imshow(opp_image_arr, cmap='Greys_r')
-		#plt.savefig(opp_image_save_addr)
-		#plt.imshow(wat_image_arr, cmap='Greys_r')
-		#plt.savefig(wat_image_save_addr)
-		plt.imshow(image_label_arr, cmap='Greys_r')
-		plt.savefig(label_save_addr)
+		#previews(fat_image_arr, fat_image_save_addr)
+		previews(inn_image_arr, inn_image_save_addr)
+		#previews(opp_image_arr, opp_image_save_addr)
+		#previews(wat_image_arr, wat_image_save_addr)
+		previews(image_label_arr, label_save_addr)
 
 		#np.save(fat_imagearr_save_addr, fat_image_arr)
 		np.save(inn_imagearr_save_addr, inn_image_arr)
 		#np.save(opp_imagearr_save_addr, opp_image_arr)
 		#np.save(wat_imagearr_save_addr, wat_image_arr)
 		np.save(labelarr_save_addr, image_label_arr)
+
+previews.close()
@@ -0,0 +1,25 @@
+from __future__ import print_function, division
+import numpy as np
+import os
+
+import sys
+sys.path.append(sys.path[0]+'/..')
+from UNet.parameter import Parameter
+from UNet.volume_store import write_patient
+
+# one (slices, H, W, modalities) array per patient instead of one .npy per slice and modality
+npy_data_address = '/DATA5_DB8/data/sxfeng/data/IVDM3Seg/npy_data' 
+data_save_address = '/DATA5_DB8/data/sxfeng/data/IVDM3Seg/volume_data' 
+
+para = Parameter()
+Modality = para.modalities   # npy_data/01/01_<modality>.npy has to exist for each of them
+
+for addr in sorted(os.listdir(npy_data_address)):
+    print('process on {}'.format(addr))
+
+    patient_addr = os.path.join(npy_data_address, addr)  #npy_data/01
+    voxel_list = [np.load(os.path.join(patient_addr, '{}_{}.npy'.format(addr, m))) for m in Modality]
+    voxel_label_arr = np.load(os.path.join(patient_addr, '{}_Labels.npy'.format(addr)))
+
+    image_arr = np.stack(voxel_list, axis=-1)   # (slices, H, W, modalities)
+    write_patient(data_save_address, addr, image_arr, voxel_label_arr, Modality)
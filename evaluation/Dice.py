@@ -13,36 +13,157 @@ and Successful detection rate(SDR)
 
 from __future__ import division, print_function
 import numpy as np 
+import scipy.ndimage as ndimg
+from scipy.optimize import linear_sum_assignment
 
+# voxel spacing in mm along the (slice, x, y) axes of the voxels
+SPACING = (1.25, 1.25, 2.0)
 
-def Dice_3D(gt_IVDset_list, pre_IVDset_list):
-	length = len(gt_IVDset_list)
-	image_list = []
-	for i in range(length):
-		gt_len = len(gt_IVDset_list[i])
-		pre_len = len(pre_IVDset_list[i])
-		union_len = len(gt_IVDset_list[i] & pre_IVDset_list[i])
-		dice = 2*union_len/(gt_len + pre_len)
-		image_list.append(dice)
-	return image_list
 
+def overlap_matrix(gtVoxel, preVoxel, gt_num, pre_num):
+	"""
+	Voxel count of every (gt label, pre label) pair in one bincount pass.
+	Row / column 0 is the background, so row sums are gt volumes and column
+	sums are pre volumes. Shape [gt_num+1, pre_num+1]
 
-def MDOC(dice_list):
-	total = 0
-	for li in dice_list:
-		total += sum(li)
+	:param gtVoxel: labeled gt voxel, labels 1..gt_num
+	:param preVoxel: labeled pre voxel, labels 1..pre_num
+	"""
+	index = gtVoxel.ravel().astype(np.int64) * (pre_num + 1) + preVoxel.ravel()
+	overlap = np.bincount(index, minlength=(gt_num + 1) * (pre_num + 1))
+	return overlap.reshape(gt_num + 1, pre_num + 1)
 
-	mdoc = total/len(dice_list)/7
-	return mdoc
 
+def _assign(cost):
+	# globally optimal one-to-one assignment, works for any number of rows and columns
+	if cost.size == 0:
+		return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+	return linear_sum_assignment(cost)
+
+
+def match_discs(overlap, min_overlap=50):
+	"""
+	Matches pre regions to gt discs one-to-one so that the total overlap is
+	maximal. A pair only counts as a match if it overlaps by more than
+	min_overlap voxels. Returns the matched pre label per gt disc, 0 if there is none.
+
+	:param overlap: overlap matrix, see overlap_matrix
+	:param min_overlap: (optional) minimal number of shared voxels of a match
+	"""
+	score = overlap[1:, 1:]
+	rows, cols = _assign(-score)
+	keep = score[rows, cols] > min_overlap
+	match = np.zeros(score.shape[0], dtype=np.int64)
+	match[rows[keep]] = cols[keep] + 1
+	return match
+
+
+def match_centroids(gt_points, pre_points, spacing=SPACING, max_dist=4):
+	"""
+	Matches pre centroids to gt centroids one-to-one so that the total distance
+	in mm is minimal. Pairs further apart than max_dist are dropped.
+
+	:param gt_points: gt centroids in voxel coordinates. Shape [n, 3]
+	:param pre_points: pre centroids in voxel coordinates. Shape [m, 3]
+	:returns match, dist: matched pre index per gt centroid (-1 if none) and
+		the distances of the matched pairs in gt order
+	"""
+	gt_points = np.asarray(gt_points, dtype=np.float64).reshape(-1, 3)
+	pre_points = np.asarray(pre_points, dtype=np.float64).reshape(-1, 3)
+	diff = (gt_points[:, np.newaxis, :] - pre_points[np.newaxis, :, :]) * np.asarray(spacing)
+	dist = np.sqrt(np.sum(np.square(diff), axis=-1))
+	dist[np.isnan(dist)] = np.inf
+
+	rows, cols = _assign(np.where(np.isinf(dist), 1e9, dist))
+	keep = dist[rows, cols] < max_dist
+	match = -np.ones(gt_points.shape[0], dtype=np.int64)
+	match[rows[keep]] = cols[keep]
+	return match, dist[rows[keep], cols[keep]].tolist()
+
+
+def disc_volumes(overlap, match):
+	"""
+	Voxel count of every gt disc and of the pre region matched to it
+	"""
+	gt_len = overlap.sum(axis=1)[1:]
+	pre_len = np.where(match > 0, overlap.sum(axis=0)[match], 0)
+	return gt_len, pre_len
+
+
+def Dice_3D(overlap, match):
+	"""
+	Dice of every gt disc with its matched pre region, from the overlap matrix
+	"""
+	gt_len, pre_len = disc_volumes(overlap, match)
+	inter = np.where(match > 0, overlap[np.arange(1, len(match) + 1), match], 0)
+	dice = 2 * inter / np.maximum(gt_len + pre_len, 1)
+	return dice.tolist()
 
-def SDDOC(dice_list, mdoc):
-	total = 0
-	for li in dice_list:
-		for dice in li:
-			total += pow(dice-mdoc, 2)
 
-	sddoc = total/(len(dice_list)*7-1)
+def _surface(mask):
+	# voxels of the mask with a background neighbour
+	return mask & ~ndimg.binary_erosion(mask)
+
+
+def surface_distances(gt_mask, pre_mask, spacing=SPACING):
+	"""
+	Distances in mm from every gt surface voxel to the pre surface and from
+	every pre surface voxel to the gt surface, read from Euclidean distance
+	transforms of the surfaces.
+
+	:returns gt_to_pre, pre_to_gt: the two arrays of surface distances
+	"""
+	gt_surface = _surface(gt_mask)
+	pre_surface = _surface(pre_mask)
+	gt_dist = ndimg.distance_transform_edt(~gt_surface, sampling=spacing)
+	pre_dist = ndimg.distance_transform_edt(~pre_surface, sampling=spacing)
+	return pre_dist[gt_surface], gt_dist[pre_surface]
+
+
+def surface_metrics(gtVoxel, preVoxel, match, spacing=SPACING, margin=2):
+	"""
+	Average absolute distance (AAD), Hausdorff distance (HD) and 95th percentile
+	Hausdorff distance (HD95) of every gt disc and its matched pre region. The
+	distance transforms only cover the joint bounding box of the two regions.
+	Discs without a match get nan.
+
+	:param gtVoxel: labeled gt voxel
+	:param preVoxel: labeled pre voxel
+	:param match: matched pre label per gt disc, see match_discs
+	:param spacing: (optional) voxel spacing in mm
+	:param margin: (optional) voxels added around the bounding box
+	:returns aad_list, hd_list, hd95_list
+	"""
+	gt_objects = ndimg.find_objects(gtVoxel)
+	pre_objects = ndimg.find_objects(preVoxel)
+	aad_list = []
+	hd_list = []
+	hd95_list = []
+	for i, m in enumerate(match):
+		if m == 0 or i >= len(gt_objects) or gt_objects[i] is None:
+			aad_list.append(np.nan)
+			hd_list.append(np.nan)
+			hd95_list.append(np.nan)
+			continue
+
+		box = tuple(slice(max(min(a.start, b.start) - margin, 0), max(a.stop, b.stop) + margin)
+					for a, b in zip(gt_objects[i], pre_objects[m - 1]))
+		gt_to_pre, pre_to_gt = surface_distances(gtVoxel[box] == i + 1, preVoxel[box] == m, spacing)
+		dist = np.concatenate([gt_to_pre, pre_to_gt])
+		aad_list.append(np.mean(dist))
+		hd_list.append(max(np.max(gt_to_pre), np.max(pre_to_gt)))
+		hd95_list.append(np.percentile(dist, 95))
+	return aad_list, hd_list, hd95_list
+
+
+def MDOC(dice_list):
+	dice_arr = np.concatenate([np.asarray(li, dtype=np.float64) for li in dice_list])
+	return np.mean(dice_arr)
+
+
+def SDDOC(dice_list, mdoc):
+	dice_arr = np.concatenate([np.asarray(li, dtype=np.float64) for li in dice_list])
+	sddoc = np.sum(np.square(dice_arr - mdoc))/(len(dice_arr)-1)
 	sddoc = np.sqrt(sddoc)
 	return sddoc
 
@@ -5,8 +5,10 @@ import matplotlib.pyplot as plt
 import numpy as np
 import os
 import time
-import scipy.ndimage.measurements as mear
-from Dice import Dice_3D, MDOC, SDDOC
+from Dice import MDOC, SDDOC
+from parallel_eval import evaluate_patients, surface_summary
+from mask_io import load_mask, save_mask
+from resize import block_reduce, upsample, resize
 
 import sys
 sys.path.append(sys.path[0]+'/..')
@@ -24,34 +26,12 @@ labeled_voxel_save_address = os.path.join(root_address, 'result/labeled_voxel')
 
 def img_resize_1(m):
     # 512 to 256
-    new_m = np.zeros([256, 256])
-    for i in range(256):
-        for j in range(256):
-            num = 0
-            if m[2*i, 2*j] == True:
-                num += 1
-            if m[2*i+1, 2*j] == True:
-                num += 1
-            if m[2*i, 2*j+1] == True:
-                num += 1
-            if m[2*i+1, 2*j+1] == True:
-                num += 1
-
-            if num >=1:
-                new_m[i, j] = 1
-            else:
-                new_m[i, j] = 0
-    return new_m
+    return block_reduce(m, 2, 'any').astype(float)
 
 
 def img_resize_2(m):
     # 128 to 256
-    new_m = np.zeros([256, 256])
-    for i in range(128):
-        for j in range(128):
-            new_m[2*i, 2*j] = new_m[2*i+1, 2*j] = new_m[2*i, 2*j+1] = new_m[2*i+1, 2*j+1] = m[i, j]
-
-    return new_m.astype(int)
+    return upsample(m, 2).astype(int)
 
 
 def img2voxel(label_pre_address, voxel_save_address, img_height=256, img_width=256):
@@ -64,21 +44,25 @@ def img2voxel(label_pre_address, voxel_save_address, img_height=256, img_width=2
             os.mkdir(voxel_save_addr)
 
         length_1 = len(os.listdir(labels_addr))  # length_1 = 36
-        voxel = np.empty((length_1, img_width, img_height))
+        voxel = None
 
         for addr_1 in os.listdir(labels_addr):   #addr_1: 0
             label_addr = os.path.join(labels_addr, addr_1)    # pre_image/01/0
             for file in os.listdir(label_addr):
                 if '_pre.npy' in file:
-                    label_arr = np.load(os.path.join(label_addr, file))
-                    if label_arr.shape[0] == 512:
-                        label_arr = img_resize_1(label_arr)
-                    elif label_arr.shape[0] == 128:
-                        label_arr = img_resize_2(label_arr)
+                    label_arr = load_mask(os.path.join(label_addr, file))
+                    if voxel is None:
+                        # slices are collected at the predicted resolution
+                        voxel = np.zeros((length_1,) + label_arr.shape, dtype=np.uint8)
                     index = int(addr_1)
                     voxel[index] = label_arr
 
-        np.save(voxel_save_addr + '/pre.npy', voxel)   ## pre_voxel/01/pre.npy
+        if voxel is None:
+            # a missing patient would shift the pairing of the sorted pre_voxel and gt lists
+            raise ValueError("No *_pre.npy slices in %s" % labels_addr)
+        # e.g. 512 or 128 predictions to the 256 ground truth, the whole volume at once
+        voxel = resize(voxel, (img_width, img_height))
+        save_mask(voxel_save_addr + '/pre.npy', voxel, compress=para.mask_rle)   ## pre_voxel/01/pre.npy
 
 
 def img2voxel_xz(label_pre_address, voxel_save_address, img_height=36, img_width=256):
@@ -91,17 +75,17 @@ def img2voxel_xz(label_pre_address, voxel_save_address, img_height=36, img_width
             os.mkdir(voxel_save_addr)
 
         length_1 = len(os.listdir(labels_addr))  
-        voxel = np.empty((36, 256, 256))
+        voxel = np.zeros((36, 256, 256), dtype=np.uint8)
 
         for addr_1 in os.listdir(labels_addr):   #addr_1: 0
             label_addr = os.path.join(labels_addr, addr_1)    # pre_image/01/0
             for file in os.listdir(label_addr):
                 if '_pre.npy' in file:
-                    label_arr = np.load(os.path.join(label_addr, file))
+                    label_arr = load_mask(os.path.join(label_addr, file))
                     index = int(addr_1)
                     voxel[:, index, :] = label_arr
 
-        np.save(voxel_save_addr + '/pre.npy', voxel)   ## pre_voxel/01/pre.npy
+        save_mask(voxel_save_addr + '/pre.npy', voxel, compress=para.mask_rle)   ## pre_voxel/01/pre.npy
 
 
 def img2voxel_yz(label_pre_address, voxel_save_address, img_height=36, img_width=256):
@@ -114,102 +98,17 @@ def img2voxel_yz(label_pre_address, voxel_save_address, img_height=36, img_width
             os.mkdir(voxel_save_addr)
 
         length_1 = len(os.listdir(labels_addr))  
-        voxel = np.empty((36, 256, 256))
+        voxel = np.zeros((36, 256, 256), dtype=np.uint8)
 
         for addr_1 in os.listdir(labels_addr):   #addr_1: 0
             label_addr = os.path.join(labels_addr, addr_1)    # pre_image/01/0
             for file in os.listdir(label_addr):
                 if '_pre.npy' in file:
-                    label_arr = np.load(os.path.join(label_addr, file))
+                    label_arr = load_mask(os.path.join(label_addr, file))
                     index = int(addr_1)
                     voxel[:, :, index] = label_arr
 
-        np.save(voxel_save_addr + '/pre.npy', voxel)   ## pre_voxel/01/pre.npy
-
-
-def _del_small_rigion_gt(voxel):
-    #for gt voxel, find the top 7 rigions and delete others
-    voxel, num = mear.label(voxel)
-    if num==7:
-        return voxel, num
-
-    num_per_rigion = dict()
-    for i in range(1, num+1):
-        tmp_arr = np.where(voxel==i)
-        num_per_rigion[i] = len(tmp_arr[0])
-
-    d = sorted(num_per_rigion.items(), key= lambda x:x[1], reverse=True)
-    index_lsit = []
-    for i in range(7):
-        index_lsit.append(d[i][0])
-    for i in range(1, num+1):
-        if not i in index_lsit:  # small region
-            tmp_arr = np.where(voxel==i)
-            for i in range(len(tmp_arr[0])):
-                voxel[tmp_arr[0][i], tmp_arr[1][i], tmp_arr[2][i]] = 0
-
-    # label the voxel again after detele small region
-    voxel, num = mear.label(voxel)
-    return voxel, num
-
-
-def _del_small_rigion_pre(voxel):
-    #for pre voxel, find the top top_num rigions and delete others
-    voxel, num = mear.label(voxel)  
-    num_per_rigion = dict()
-    for i in range(1, num+1):
-        tmp_arr = np.where(voxel==i)
-        if len(tmp_arr[0]) > 500:
-            for j in range(len(tmp_arr[0])):
-                voxel[tmp_arr[0][j], tmp_arr[1][j], tmp_arr[2][j]] = 1
-            num_per_rigion[i] = len(tmp_arr[0])
-        else:
-            for j in range(len(tmp_arr[0])):
-                voxel[tmp_arr[0][j], tmp_arr[1][j], tmp_arr[2][j]] = 0
-
-    # label the voxel again after detele small region
-    voxel, num = mear.label(voxel)
-    return voxel, num
-
-
-def _get_set(gtVoxel, preVoxel, labeled_num):
-    """
-    Get the list of gtVoxel set and list of preVoxel set, and match them
-
-    :param gtVoxel: labeled gtVoxel
-    :param preVoxel: labeled preVoxel
-    """
-    nz = gtVoxel.shape[0]
-    nx = gtVoxel.shape[1]
-    ny = gtVoxel.shape[2]
-    gt_IVDset_list = []
-    pre_IVDset_list = []
-    for i in range(7):
-        gt_IVDset_list.append(set())
-    for i in range(labeled_num):
-        pre_IVDset_list.append(set())
-
-    for i in range(1, 8):
-        tmp_arr = np.where(gtVoxel==i)
-        for j in range(len(tmp_arr[0])):
-            gt_IVDset_list[i-1].add(tmp_arr[0][j]*nx*ny+tmp_arr[1][j]*ny+tmp_arr[2][j])
-    for i in range(1, labeled_num+1):
-        tmp_arr = np.where(preVoxel==i)
-        for j in range(len(tmp_arr[0])):
-            pre_IVDset_list[i-1].add(tmp_arr[0][j]*nx*ny+tmp_arr[1][j]*ny+tmp_arr[2][j])
-
-    # match
-    for i in range(7):
-        tmp_set = gt_IVDset_list[i]
-        for j in range(i, labeled_num):
-            if len(tmp_set & pre_IVDset_list[j]) > 50:
-                tmp_set_1 = pre_IVDset_list[i]
-                pre_IVDset_list[i] = pre_IVDset_list[j]
-                pre_IVDset_list[j] = tmp_set_1
-
-    print([len(gt_IVDset_list[i]) for i in range(7)])
-    print([len(pre_IVDset_list[i]) for i in range(7)])
-    return gt_IVDset_list, pre_IVDset_list[0:7]
+        save_mask(voxel_save_addr + '/pre.npy', voxel, compress=para.mask_rle)   ## pre_voxel/01/pre.npy
 
 
 def eval(gt_voxel_address, pre_voxel_address, labeled_voxel_save_address):
@@ -225,7 +124,7 @@ def eval(gt_voxel_address, pre_voxel_address, labeled_voxel_save_address):
     pre_voxel_addr = [os.path.join(pre_voxel_address, i) for i in pre_voxel_addr] # pre_voxel/01
     labeled_voxel_save_addr = [path.replace('pre_voxel', 'labeled_voxel') for path in pre_voxel_addr]  # labeled_voxel/01
 
-    dice_list = []
+    jobs = []
     for i in range(len(gt_voxel_addr)):
         gt_addr = ''
         for filename in os.listdir(gt_voxel_addr[i]): 
@@ -233,30 +132,26 @@ def eval(gt_voxel_address, pre_voxel_address, labeled_voxel_save_address):
                 gt_addr = os.path.join(gt_voxel_addr[i], filename)  # test_npydata/01/01_Labels.npy
 
         pre_addr = os.path.join(pre_voxel_addr[i], 'pre.npy')  # pre_voxel/01/pre.npy
-        print('evaluation on {}'.format(pre_addr))
         
         if not os.path.exists(labeled_voxel_save_addr[i]):
             os.mkdir(labeled_voxel_save_addr[i])
         labeled_addr = os.path.join(labeled_voxel_save_addr[i], 'labeled.npy')
+        jobs.append((gt_addr, pre_addr, labeled_addr))
 
-        gtVoxel = np.load(gt_addr)
-        preVoxel = np.load(pre_addr)
-        gtVoxel, _ = _del_small_rigion_gt(gtVoxel)
-        labeledVoxel, labeled_num = _del_small_rigion_pre(preVoxel)
-        print(labeled_num)
-        np.save(labeled_addr, labeledVoxel)  # save labeled voxel
-        gt_IVDset_list, pre_IVDset_list = _get_set(gtVoxel, labeledVoxel, labeled_num)
-        image_dice_list = Dice_3D(gt_IVDset_list, pre_IVDset_list)
-        dice_list.append(image_dice_list)
-        print(image_dice_list)
+    results = evaluate_patients(jobs, workers=para.eval_workers, compress=para.mask_rle)
+    dice_list = [result['dice'] for result in results]
 
+    aad, hd, hd95 = surface_summary(results)
+    print('AAD: {:.4f} mm, HD: {:.4f} mm, HD95: {:.4f} mm'.format(aad, hd, hd95))
     mdoc = MDOC(dice_list)
     sddoc = SDDOC(dice_list, mdoc)
     return mdoc, sddoc
 
 
 if __name__ == '__main__':
-    img2voxel(label_pre_address, voxel_save_address)
+    if para.save_slices:
+        # UNet/predict.py writes pre_voxel directly, pre_image only exists with save_slices
+        img2voxel(label_pre_address, voxel_save_address)
     print('start evaluation')
     mdoc, sddoc = eval(voxel_address, voxel_save_address,  labeled_voxel_save_address)
     print(mdoc)
@@ -0,0 +1,122 @@
+'''
+Compact storage of predicted and labeled volumes.
+
+Formats:
+    uint8     labels 0..255 as a plain uint8 .npy. np.load still reads it and
+              load_mask maps it into memory instead of reading it
+    packbits  binary masks, one bit per voxel
+    rle       run lengths of the uint8 labels, for sparse masks
+
+packbits and rle files are npz containers written under the usual names
+(pre.npy, labeled.npy), load_mask finds the format from the file itself. Old
+float64 and int64 volumes are still loaded as they are.
+
+Usage:
+save_mask('pre_voxel/01/pre.npy', mask)
+mask = load_mask('pre_voxel/01/pre.npy')
+'''
+
+from __future__ import division, print_function
+import numpy as np
+
+_ZIP_MAGIC = b'PK\x03\x04'
+
+
+def is_binary(mask):
+    """
+    True if every voxel of the mask is 0 or 1
+    """
+    mask = np.asarray(mask)
+    if mask.dtype == bool:
+        return True
+    return mask.size == 0 or (mask.min() >= 0 and mask.max() <= 1 and np.array_equal(mask, mask.astype(bool)))
+
+
+def to_uint8(labels):
+    """
+    Labels as uint8, raises ValueError for labels outside 0..255
+    """
+    labels = np.asarray(labels)
+    if labels.dtype == np.uint8:
+        return labels
+    if labels.size and (labels.min() < 0 or labels.max() > 255):
+        raise ValueError("Labels outside 0..255 can not be stored as uint8")
+    return labels.astype(np.uint8)
+
+
+def rle_encode(labels):
+    """
+    Run length encoding of the flattened labels
+
+    :returns values, lengths: uint8 value and uint32 length of every run
+    """
+    flat = to_uint8(labels).ravel()
+    if flat.size == 0:
+        return np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.uint32)
+    starts = np.concatenate(([0], np.flatnonzero(flat[1:] != flat[:-1]) + 1))
+    lengths = np.diff(np.append(starts, flat.size))
+    return flat[starts], lengths.astype(np.uint32)
+
+
+def rle_decode(values, lengths, shape):
+    return np.repeat(values, lengths).reshape(shape)
+
+
+def save_mask(path, mask, fmt=None, compress=False):
+    """
+    Saves a mask or label volume in a compact format
+
+    :param path: target file, e.g. pre_voxel/01/pre.npy
+    :param mask: binary mask or labels 0..255
+    :param fmt: (optional) 'packbits' or 'uint8', default: packbits for binary masks
+    :param compress: (optional) run length encode the labels instead, default=False
+    """
+    mask = np.asarray(mask)
+    binary = is_binary(mask)
+    if fmt is None:
+        fmt = 'packbits' if binary else 'uint8'
+    if compress:
+        fmt = 'rle'
+
+    if fmt == 'uint8':
+        np.save(path, to_uint8(mask))
+        return
+    if fmt == 'packbits':
+        if not binary:
+            raise ValueError("packbits needs a binary mask")
+        arrays = {'data': np.packbits(mask.astype(bool).ravel())}
+    elif fmt == 'rle':
+        values, lengths = rle_encode(mask)
+        arrays = {'values': values, 'lengths': lengths, 'binary': np.array(binary)}
+    else:
+        raise ValueError("Unknown mask format: %s" % fmt)
+
+    # a file object keeps the name, np.savez would append .npz
+    with open(path, 'wb') as f:
+        np.savez(f, format=np.array(fmt), shape=np.array(mask.shape, dtype=np.int64), **arrays)
+
+
+def load_mask(path, mmap=True):
+    """
+    Loads a volume written by save_mask or np.save
+
+    :param path: .npy file
+    :param mmap: (optional) memory map plain .npy files instead of reading them, default=True
+    :returns mask: bool for binary masks, uint8 for labels. packbits and rle volumes
+        are unpacked once and returned as bool views of the unpacked bytes
+    """
+    with open(path, 'rb') as f:
+        magic = f.read(len(_ZIP_MAGIC))
+    if magic != _ZIP_MAGIC:
+        return np.load(path, mmap_mode='r' if mmap else None)
+
+    with np.load(path) as npz:
+        fmt = str(npz['format'])
+        shape = tuple(npz['shape'])
+        if fmt == 'packbits':
+            size = int(np.prod(shape))
+            return np.unpackbits(npz['data'])[:size].reshape(shape).view(bool)
+        if fmt == 'rle':
+            labels = rle_decode(npz['values'], npz['lengths'], shape)
+            return labels.view(bool) if bool(npz['binary']) else labels
+    raise ValueError("Unknown mask format in %s: %s" % (path, fmt))
@@ -0,0 +1,108 @@
+'''
+Evaluation of many patients on a process pool.
+
+Every patient is independent: load, relabel, match and measure. The driver
+fans the patients out over the pool and collects the results in input order,
+so the summary statistics are the same as for a serial run. Only the file
+names travel to the workers and every worker holds one patient at a time.
+'''
+
+from __future__ import division, print_function
+import numpy as np
+from functools import partial
+from multiprocessing import Pool
+import scipy.ndimage as ndimg
+
+from Dice import overlap_matrix, match_discs, match_centroids, disc_volumes, surface_metrics, Dice_3D
+from postprocess import del_small_region_gt, del_small_region_pre
+from mask_io import load_mask, save_mask
+from resize import resize
+
+
+def _load(voxel):
+    if isinstance(voxel, np.ndarray):
+        return voxel
+    return load_mask(voxel)
+
+
+def evaluate_patient(job, compress=False):
+    """
+    Evaluates one patient
+
+    :param job: (gt_addr, pre_addr, labeled_addr) or (gt_addr, pre_addr, labeled_addr, name).
+        gt_addr and pre_addr are .npy files or the volumes themselves, the pre voxel is
+        resized to the in-plane size of the gt voxel. The labeled pre voxel
+        is saved to labeled_addr unless it is None. name defaults to pre_addr
+    :param compress: (optional) run length encode the saved labeled voxel, default=False
+    :returns result: dict with the name, the number of labeled pre regions,
+        gt and matched pre volumes, dice, centroid distances, AAD, HD and HD95
+    """
+    gt_addr, pre_addr, labeled_addr = job[:3]
+    name = job[3] if len(job) > 3 else pre_addr
+    gtVoxel = _load(gt_addr)
+    preVoxel = _load(pre_addr)
+    if preVoxel.shape[-2:] != gtVoxel.shape[-2:]:
+        # predictions of a 512 or 128 model are compared on the ground truth grid
+        preVoxel = resize(preVoxel, gtVoxel.shape[-2:])
+    gtVoxel, gt_num = del_small_region_gt(gtVoxel)
+    labeledVoxel, labeled_num = del_small_region_pre(preVoxel)
+    if labeled_addr is not None:
+        save_mask(labeled_addr, labeledVoxel, compress=compress)  # save labeled voxel as uint8
+
+    point_list1 = ndimg.center_of_mass(gtVoxel, gtVoxel, range(1, gt_num+1))
+    point_list2 = ndimg.center_of_mass(labeledVoxel, labeledVoxel, range(1, labeled_num+1))
+
+    overlap = overlap_matrix(gtVoxel, labeledVoxel, gt_num, labeled_num)
+    match = match_discs(overlap)
+    gt_len, pre_len = disc_volumes(overlap, match)
+    aad, hd, hd95 = surface_metrics(gtVoxel, labeledVoxel, match)
+    return {'name': name,
+            'labeled_num': labeled_num,
+            'gt_len': gt_len.tolist(),
+            'pre_len': pre_len.tolist(),
+            'dice': Dice_3D(overlap, match),
+            'dist': match_centroids(point_list1, point_list2)[1],
+            'aad': aad,
+            'hd': hd,
+            'hd95': hd95}
+
+
+def evaluate_patients(jobs, workers=1, compress=False, pool=None):
+    """
+    Evaluates all patients, on `workers` processes if workers > 1
+
+    :param jobs: list of evaluate_patient jobs
+    :param workers: (optional) size of the process pool, default=1
+    :param compress: (optional) run length encode the saved labeled voxels, default=False
+    :param pool: (optional) process pool to evaluate on instead, e.g. one started before a
+        TensorFlow session was opened, which a forked pool would inherit. Not closed here
+    :returns results: evaluate_patient results in the order of jobs
+    """
+    evaluate = partial(evaluate_patient, compress=compress)
+    if pool is not None:
+        results = list(pool.imap(evaluate, jobs, chunksize=1))
+    elif workers > 1 and len(jobs) > 1:
+        pool = Pool(min(workers, len(jobs)))
+        try:
+            results = list(pool.imap(evaluate, jobs, chunksize=1))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [evaluate(job) for job in jobs]
+
+    for result in results:
+        print('evaluation on {}'.format(result['name']))
+        print(result['labeled_num'])
+        print(result['gt_len'])
+        print(result['pre_len'])
+        print('AAD {}, HD {}'.format(result['aad'], result['hd']))
+        print(result['dice'])
+    return results
+
+
+def surface_summary(results):
+    """
+    Mean AAD, HD and HD95 over all matched discs
+    """
+    return [np.nanmean(np.concatenate([result[k] for result in results])) for k in ('aad', 'hd', 'hd95')]
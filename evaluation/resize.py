@@ -0,0 +1,120 @@
+'''
+Resolution adaptation of slices and volumes by integer factors.
+
+Both functions work on the last two axes, so a slice [H, W] and a volume
+[slices, H, W] are resized in one call. Downsampling combines the f strided
+sub-grids x[..., k::f, :] of every axis with one ufunc pass each, which is
+much faster than reducing over the short axes of [..., H/f, f, W/f, f] blocks.
+Upsampling repeats every pixel f times per axis.
+
+Downsampling modes:
+    any     1 if any pixel of the block is set (binary masks, the 512 -> 256 adapter)
+    label   most frequent label of the block, ties go to the lower label
+    max     largest value of the block
+    mean    average of the block (probabilities)
+'''
+
+from __future__ import division, print_function
+import numpy as np
+
+
+def _factors(factor):
+    if np.isscalar(factor):
+        return int(factor), int(factor)
+    return int(factor[0]), int(factor[1])
+
+
+def _accumulate(volume, fy, fx, op, dtype=None):
+    # combines the pixels of every fy x fx block with the binary ufunc op
+    rows = np.array(volume[..., 0::fy, :], dtype=dtype)
+    for k in range(1, fy):
+        op(rows, volume[..., k::fy, :], out=rows)
+    out = rows[..., 0::fx].copy()
+    for k in range(1, fx):
+        op(out, rows[..., k::fx], out=out)
+    return out
+
+
+def _labels(volume):
+    if volume.dtype.kind in 'ub' or (volume.dtype.kind == 'i' and volume.min() >= 0):
+        # cheaper than the sort of np.unique for the small labels of a mask
+        return np.flatnonzero(np.bincount(volume.ravel().astype(np.intp, copy=False))).astype(volume.dtype)
+    return np.unique(volume)
+
+
+def block_reduce(volume, factor, mode='any'):
+    """
+    Downsamples the last two axes by an integer factor
+
+    :param volume: array of shape [..., H, W]
+    :param factor: factor for both axes or (factor H, factor W)
+    :param mode: (optional) 'any', 'label', 'max' or 'mean', default='any'
+    :returns reduced: Shape [..., H / factor, W / factor]. bool for 'any', float for 'mean',
+        the input dtype otherwise
+    """
+    volume = np.asarray(volume)
+    fy, fx = _factors(factor)
+    h, w = volume.shape[-2:]
+    if h % fy or w % fx:
+        raise ValueError("Shape %s is not divisible by %s" % ((h, w), (fy, fx)))
+
+    if mode == 'any':
+        return _accumulate(volume.astype(bool, copy=False), fy, fx, np.logical_or)
+    if mode == 'max':
+        return _accumulate(volume, fy, fx, np.maximum)
+    if mode == 'mean':
+        return _accumulate(volume, fy, fx, np.add, dtype=np.float64) / (fy * fx)
+    if mode == 'label':
+        # block counts fit uint16 up to 255 x 255 blocks
+        count_dtype = np.uint16 if fy * fx < 2**16 else np.uint32
+        labels = _labels(volume)
+        best = np.full(volume.shape[:-2] + (h // fy, w // fx), labels[0], dtype=volume.dtype)
+        best_count = _accumulate(volume == labels[0], fy, fx, np.add, dtype=count_dtype)
+        for label in labels[1:]:
+            count = _accumulate(volume == label, fy, fx, np.add, dtype=count_dtype)
+            better = count > best_count
+            best[better] = label
+            best_count[better] = count[better]
+        return best
+    raise ValueError("Unknown mode: %s" % mode)
+
+
+def upsample(volume, factor):
+    """
+    Nearest neighbour upsampling of the last two axes, labels and probabilities keep their values
+
+    :param volume: array of shape [..., H, W]
+    :param factor: factor for both axes or (factor H, factor W)
+    :returns upsampled: Shape [..., H * factor, W * factor]
+    """
+    fy, fx = _factors(factor)
+    return np.repeat(np.repeat(volume, fy, axis=-2), fx, axis=-1)
+
+
+def resize(volume, shape, mode='any'):
+    """
+    Resizes the last two axes to `shape`, every axis by an integer factor
+
+    :param volume: array of shape [..., H, W]
+    :param shape: target (H, W)
+    :param mode: (optional) block_reduce mode of the axes that get smaller, default='any'
+    :returns resized: Shape [..., shape[0], shape[1]]
+    """
+    volume = np.asarray(volume)
+    down, up = [], []
+    for size, target in zip(volume.shape[-2:], shape):
+        if size >= target:
+            if size % target:
+                raise ValueError("Can not resize %s to %s by integer factors" % (volume.shape[-2:], tuple(shape)))
+            down.append(size // target)
+            up.append(1)
+        else:
+            if target % size:
+                raise ValueError("Can not resize %s to %s by integer factors" % (volume.shape[-2:], tuple(shape)))
+            down.append(1)
+            up.append(target // size)
+    if down != [1, 1]:
+        volume = block_reduce(volume, down, mode)
+    if up != [1, 1]:
+        volume = upsample(volume, up)
+    return volume